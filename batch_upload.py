@@ -0,0 +1,87 @@
+import time
+import asyncio
+
+from typing import Awaitable, Callable, Optional
+
+from env import UPLOAD_GLOBAL_CONCURRENCY, UPLOAD_GROUP_CONCURRENCY, PUBLISH_MAX_ATTEMPTS
+from database import *
+from media_cache import media_cache
+from vk_api_requests import upload_video
+from metrics import RETRIES_TOTAL, FAILURES_TOTAL
+from retry import CircuitOpenError
+
+
+def retry_delay(attempts: int) -> float:
+    return min(60 * 2 ** (attempts - 1), 3600)
+
+
+class BatchUploader:
+    """
+    Загружает видео задач публикации в VK параллельно.
+    Одновременно идет не больше global_limit загрузок всего и group_limit в одну группу.
+    Сначала берется слот группы, затем общий, чтобы ждущие своей группы задачи не занимали общие слоты.
+    """
+
+    def __init__(self, global_limit: int = UPLOAD_GLOBAL_CONCURRENCY, group_limit: int = UPLOAD_GROUP_CONCURRENCY):
+        self.group_limit = group_limit
+        self._global = asyncio.Semaphore(global_limit)
+        self._groups: dict[int, asyncio.Semaphore] = {}
+
+    def _group(self, group_id: int) -> asyncio.Semaphore:
+        semaphore = self._groups.get(group_id)
+        if semaphore is None:
+            semaphore = self._groups[group_id] = asyncio.Semaphore(self.group_limit)
+        return semaphore
+
+    async def upload_job(self, job) -> bool:
+        """
+        Загружает видео задачи в состоянии uploading и сохраняет video_id.
+        При ошибке задача возвращается в очередь предварительной загрузки с задержкой,
+        после PUBLISH_MAX_ATTEMPTS неудач - уходит в dead. Пока цепь VK разомкнута,
+        задача откладывается без расхода попыток.
+        """
+        async with self._group(job['group_id']), self._global:
+            try:
+                video_id = await upload_video(job['group_id'], job['description'], job['file_path'], job['tg_id'], job['id'])
+            except CircuitOpenError as e:
+                print(f"Загрузка видео задачи {job['id']} отложена: {e}")
+                await run_db(postpone_publish_job, job['id'], repr(e), e.retry_at)
+                return False
+            except Exception as e:
+                attempts = job['attempts'] + 1
+                if attempts < PUBLISH_MAX_ATTEMPTS:
+                    RETRIES_TOTAL.inc(operation='upload')
+                    print(f"Ошибка загрузки видео задачи {job['id']} (попытка {attempts}): {e!r}")
+                    await run_db(fail_publish_job_upload, job['id'], repr(e), time.time() + retry_delay(attempts))
+                else:
+                    FAILURES_TOTAL.inc(operation='upload')
+                    print(f"Видео задачи {job['id']} не загружено после {attempts} попыток, задача в dead: {e!r}")
+                    await run_db(fail_publish_job_upload, job['id'], repr(e))
+                    media_cache.unpin(job['file_path'])
+                return False
+
+        await run_db(set_publish_job_video, job['id'], video_id)
+        media_cache.unpin(job['file_path'])
+        return True
+
+    async def upload_batch(self, jobs, on_progress: Optional[Callable[[int, int, int], Awaitable]] = None) -> tuple[int, int]:
+        """
+        Загружает все задачи пачки параллельно. После каждого видео вызывает
+        on_progress(загружено, ошибок, всего). Возвращает число загруженных и неудачных.
+        """
+        uploaded = failed = 0
+
+        async def upload(job):
+            nonlocal uploaded, failed
+            if await self.upload_job(job):
+                uploaded += 1
+            else:
+                failed += 1
+            if on_progress is not None:
+                await on_progress(uploaded, failed, len(jobs))
+
+        await asyncio.gather(*(upload(job) for job in jobs))
+        return uploaded, failed
+
+
+batch_uploader = BatchUploader()
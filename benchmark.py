@@ -0,0 +1,440 @@
+"""
+Сквозной нагрузочный прогон бота на локальных заглушках VK API и Telegram Bot API.
+
+Ролики прогоняются через настоящие process_video -> upload_all_videos -> очередь
+публикации. Заглушки поднимаются на localhost, задержка и доля ошибок задаются
+аргументами. В конце печатается пропускная способность, p50/p99 сквозной задержки
+(от получения апдейта до wall.post), средние времена этапов и пиковый RSS.
+
+Пример: python benchmark.py --clips 40 --batch 10 --admins 2 --long-share 0.25 --vk-latency 0.05
+"""
+import os
+import re
+import json
+import math
+import time
+import random
+import socket
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from datetime import datetime
+
+from aiohttp import web
+
+BENCH_TOKEN = '123456:benchmark'
+GROUP_ID = 1000
+SHORT_DURATION = 5
+LONG_DURATION = 65
+API_CALL = re.compile(r'API\.([\w.]+)\(')
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон VKClipsBot на локальных заглушках')
+    parser.add_argument('--clips', type=int, default=20, help='всего роликов')
+    parser.add_argument('--batch', type=int, default=10, help='роликов в одной загрузке (/upload)')
+    parser.add_argument('--admins', type=int, default=1, help='администраторов, загружающих параллельно')
+    parser.add_argument('--album', action='store_true', help='отправлять ролики пачки одним альбомом')
+    parser.add_argument('--long-share', type=float, default=0.0, help=f'доля роликов длиннее {LONG_DURATION - 1} c (нужна обрезка)')
+    parser.add_argument('--vk-latency', type=float, default=0.0, help='задержка ответа заглушки VK, c')
+    parser.add_argument('--tg-latency', type=float, default=0.0, help='задержка ответа заглушки Telegram, c')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля запросов, на которые заглушки отвечают ошибкой')
+    parser.add_argument('--timeout', type=float, default=600, help='максимальная длительность прогона, c')
+    parser.add_argument('--workdir', default=None, help='каталог для базы и кэша (по умолчанию временный)')
+    return parser.parse_args()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list[float], share: float) -> float:
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(share * len(ordered)) - 1))]
+
+
+def make_clip(ffmpeg: str, path: str, duration: int) -> bytes:
+    subprocess.run([
+        ffmpeg, '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', 'testsrc=size=320x240:rate=25',
+        '-f', 'lavfi', '-i', 'sine=frequency=440',
+        '-t', str(duration), '-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'aac', '-shortest', path
+    ], check=True)
+    with open(path, 'rb') as clip:
+        return clip.read()
+
+
+class FakeServer:
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.app = web.Application(client_max_size=1024 ** 3)
+        self._runner = None
+
+    async def delay(self) -> None:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def inject_error(self) -> bool:
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    async def start(self, port: int) -> None:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', port).start()
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class FakeTelegram(FakeServer):
+    """
+    Заглушка Bot API: getFile, скачивание файлов и методы отправки сообщений.
+    """
+
+    def __init__(self, latency: float, error_rate: float):
+        super().__init__(latency, error_rate)
+        self.files: dict[str, bytes] = {}
+        self._message_id = 1_000_000
+        self.app.router.add_post('/bot{token}/{method}', self.handle_method)
+        self.app.router.add_get('/file/bot{token}/{path:.+}', self.handle_file)
+
+    def _message(self, chat_id, text: str = '') -> dict:
+        self._message_id += 1
+        return {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            'text': text,
+        }
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        await self.delay()
+        method = request.match_info['method']
+        params = dict(await request.post())
+        if method == 'getFile':
+            file_id = params['file_id']
+            result = {
+                'file_id': file_id,
+                'file_unique_id': file_id,
+                'file_size': len(self.files[file_id]),
+                'file_path': f'videos/{file_id}.mp4',
+            }
+        elif method in ('sendMessage', 'editMessageText'):
+            result = self._message(params.get('chat_id', 0), params.get('text', ''))
+        elif method == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'benchmark', 'username': 'benchmark_bot'}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def handle_file(self, request: web.Request) -> web.StreamResponse:
+        await self.delay()
+        if self.inject_error():
+            return web.Response(status=500, text='injected error')
+        file_id = os.path.splitext(os.path.basename(request.match_info['path']))[0]
+        data = self.files[file_id]
+        match = re.match(r'bytes=(\d+)-', request.headers.get('Range', ''))
+        if match:
+            offset = int(match.group(1))
+            return web.Response(status=206, body=data[offset:])
+        return web.Response(body=data)
+
+
+class FakeVK(FakeServer):
+    """
+    Заглушка VK API: video.save, сервер загрузки, wall.post, execute и oauth2/auth VK ID.
+    """
+
+    def __init__(self, latency: float, error_rate: float, port: int):
+        super().__init__(latency, error_rate)
+        self.port = port
+        self._video_id = 0
+        self._post_id = 0
+        self.uploaded: set[int] = set()
+        self.posts: dict[int, float] = {}
+        self.app.router.add_post('/method/{method}', self.handle_method)
+        self.app.router.add_get('/method/{method}', self.handle_method)
+        self.app.router.add_post('/upload/{video_id}', self.handle_upload)
+        self.app.router.add_post('/oauth2/auth', self.handle_auth)
+
+    def call(self, method: str, params: dict):
+        if self.inject_error():
+            return {'error_code': 10, 'error_msg': 'Internal server error: injected'}, None
+        if method == 'video.save':
+            self._video_id += 1
+            return None, {
+                'upload_url': f'http://127.0.0.1:{self.port}/upload/{self._video_id}',
+                'video_id': self._video_id,
+                'owner_id': -int(params.get('group_id', GROUP_ID)),
+            }
+        if method == 'wall.post':
+            video_id = int(str(params['attachments']).rsplit('_', 1)[1])
+            self.posts[video_id] = time.time()
+            self._post_id += 1
+            return None, {'post_id': self._post_id}
+        if method == 'groups.getById':
+            return None, {'groups': [{'id': GROUP_ID, 'name': 'Benchmark group', 'screen_name': 'benchmark'}]}
+        if method == 'secure.checkToken':
+            return None, {'success': 1}
+        return {'error_code': 3, 'error_msg': f'Unknown method {method}'}, None
+
+    def execute(self, code: str) -> dict:
+        decoder = json.JSONDecoder()
+        body = code.strip().removeprefix('return [').removesuffix('];')
+        position = 0
+        results, errors = [], []
+        while position < len(body):
+            match = API_CALL.match(body, position)
+            params, position = decoder.raw_decode(body, match.end())
+            position += 1
+            if position < len(body) and body[position] == ',':
+                position += 1
+            error, result = self.call(match.group(1), params)
+            if error is not None:
+                errors.append({'method': match.group(1), **error})
+                results.append(False)
+            else:
+                results.append(result)
+        response = {'response': results}
+        if errors:
+            response['execute_errors'] = errors
+        return response
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        await self.delay()
+        method = request.match_info['method']
+        params = dict(request.query) if request.method == 'GET' else dict(await request.post())
+        if method == 'execute':
+            return web.json_response(self.execute(params['code']))
+        error, result = self.call(method, params)
+        if error is not None:
+            return web.json_response({'error': error})
+        return web.json_response({'response': result})
+
+    async def handle_upload(self, request: web.Request) -> web.Response:
+        await self.delay()
+        if self.inject_error():
+            return web.Response(status=500, text='injected error')
+        video_id = int(request.match_info['video_id'])
+        content_range = request.headers.get('Content-Range')
+        await request.read()
+        if content_range:
+            start, end, total = map(int, re.match(r'bytes (\d+)-(\d+)/(\d+)', content_range).groups())
+            if end + 1 < total:
+                return web.Response(status=201, text=f'0-{end}/{total}')
+        self.uploaded.add(video_id)
+        return web.json_response({'video_id': video_id, 'size': 0})
+
+    async def handle_auth(self, request: web.Request) -> web.Response:
+        await self.delay()
+        return web.json_response({
+            'access_token': 'benchmark-access', 'refresh_token': 'benchmark-refresh', 'expires_in': 3600,
+        })
+
+
+def configure_environment(workdir: str, tg_port: int, vk_port: int) -> None:
+    """
+    Направляет бота на заглушки. Должна вызываться до импорта модулей бота.
+    """
+    os.environ.update({
+        'BOT_TOKEN': BENCH_TOKEN,
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{tg_port}',
+        'VK_API_URL': f'http://127.0.0.1:{vk_port}/method',
+        'VK_ID_URL': f'http://127.0.0.1:{vk_port}',
+        'DATABASE_PATH': os.path.join(workdir, 'benchmark.db'),
+        'MEDIA_CACHE_DIR': os.path.join(workdir, 'cache'),
+        'WORKER_PROCESSES': '0',
+        'METRICS_PORT': '0',
+        'PUBLISH_POLL_INTERVAL': '0.5',
+        'PUBLISH_GROUP_SPACING': '0',
+        'PUBLISH_TOKEN_SPACING': '0',
+    })
+
+
+async def run_admin(bot_module, admin_index: int, clips: list[tuple[str, int]], args, sent_at: dict,
+                    handlers: list) -> None:
+    """
+    Загружает ролики одного администратора пачками по args.batch, как это делает /upload.
+    Апдейты обрабатываются задачами, как при polling; следующая пачка отправляется,
+    когда обработчик очистит состояние FSM.
+    """
+    from aiogram import types
+    from env import TIMEZONE
+    import pytz
+
+    bot, dp = bot_module.bot, bot_module.dp
+    user_id = chat_id = 10_000 + admin_index
+    context = dp.fsm.get_context(bot=bot, chat_id=chat_id, user_id=user_id)
+
+    for start in range(0, len(clips), args.batch):
+        batch = clips[start:start + args.batch]
+        await context.set_state(bot_module.UploadStates.waiting_for_videos)
+        await context.update_data(
+            group_ids=[GROUP_ID],
+            video_count=len(batch), videos=[],
+            publish_time=datetime.now(pytz.timezone(TIMEZONE)).replace(tzinfo=None),
+        )
+
+        updates = []
+        for offset, (file_id, duration) in enumerate(batch):
+            message_id = start + offset + 1
+            message = {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'admin', 'username': f'bench{admin_index}'},
+                'video': {
+                    'file_id': file_id, 'file_unique_id': file_id,
+                    'width': 320, 'height': 240, 'duration': duration,
+                },
+            }
+            if args.album:
+                message['media_group_id'] = f'{chat_id}-{start}'
+            updates.append(types.Update.model_validate(
+                {'update_id': user_id * 100_000 + message_id, 'message': message}, context={'bot': bot}
+            ))
+
+        for file_id, _ in batch:
+            sent_at[file_id] = time.time()
+        tasks = [asyncio.create_task(dp.feed_update(bot, update)) for update in updates]
+        handlers.extend(tasks)
+        while await context.get_state() is not None and not all(task.done() for task in tasks):
+            await asyncio.sleep(0.05)
+
+
+async def wait_for_jobs(total: int, timeout: float) -> list:
+    from database import run_db, get_connection
+
+    def fetch():
+        cursor = get_connection().cursor()
+        cursor.execute('SELECT file_path, state, due_at, updated_at FROM publish_jobs')
+        return cursor.fetchall()
+
+    deadline = time.time() + timeout
+    while True:
+        rows = await run_db(fetch)
+        finished = [row for row in rows if row[1] in ('done', 'dead')]
+        # Длинный ролик нарезается на несколько клипов, у каждого своя задача
+        if len(rows) >= total and len(finished) == len(rows) or time.time() > deadline:
+            return rows
+        await asyncio.sleep(0.2)
+
+
+async def main() -> None:
+    args = parse_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='vkclips-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    tg_port, vk_port = free_port(), free_port()
+    configure_environment(workdir, tg_port, vk_port)
+
+    from moviepy.config import FFMPEG_BINARY
+
+    telegram = FakeTelegram(args.tg_latency, args.error_rate)
+    vk = FakeVK(args.vk_latency, args.error_rate, vk_port)
+    await telegram.start(tg_port)
+    await vk.start(vk_port)
+
+    print(f"Подготовка {args.clips} роликов в {workdir}...")
+    short_clip = make_clip(FFMPEG_BINARY, os.path.join(workdir, 'short.mp4'), SHORT_DURATION)
+    long_clip = make_clip(FFMPEG_BINARY, os.path.join(workdir, 'long.mp4'), LONG_DURATION) if args.long_share else b''
+    clips = []
+    for index in range(args.clips):
+        file_id = f'clip{index:05d}'
+        is_long = random.random() < args.long_share
+        # Уникальный хвост после moov-атома не мешает ffmpeg и исключает дедупликацию в кэше
+        telegram.files[file_id] = (long_clip if is_long else short_clip) + file_id.encode() * 4
+        clips.append((file_id, LONG_DURATION if is_long else SHORT_DURATION))
+
+    import bot as bot_module
+    from database import run_db, add_user_if_not_exists, set_user_admin, update_token, save_vk_group
+    from publish_queue import publish_dispatcher
+    from vk_client import vk_client
+    from tg_download import close_download_session
+    from transcoder import transcoder
+    from metrics import (
+        TG_DOWNLOAD_SECONDS, TRANSCODE_SECONDS, VK_VIDEO_SAVE_SECONDS,
+        VK_UPLOAD_SECONDS, VK_WALL_POST_SECONDS, DB_QUERY_SECONDS,
+    )
+    from env import MAX_INFLIGHT_UPDATES
+
+    for admin_index in range(args.admins):
+        user_id = 10_000 + admin_index
+        await run_db(add_user_if_not_exists, user_id, f'bench{admin_index}')
+        await run_db(set_user_admin, f'bench{admin_index}')
+        await run_db(update_token, user_id, f'token-{admin_index}', f'refresh-{admin_index}', int(time.time()) + 86400)
+    await run_db(save_vk_group, 'https://vk.com/benchmark', 'Benchmark group', 'benchmark', GROUP_ID)
+
+    bot_module.register_handlers()
+    bot_module.dp.update.outer_middleware(bot_module.InflightLimit(MAX_INFLIGHT_UPDATES))
+    await publish_dispatcher.start()
+
+    sent_at: dict[str, float] = {}
+    handlers: list[asyncio.Task] = []
+    started = time.time()
+    try:
+        await asyncio.gather(*(
+            run_admin(bot_module, admin_index, clips[admin_index::args.admins], args, sent_at, handlers)
+            for admin_index in range(args.admins)
+        ))
+        rows = await wait_for_jobs(len(clips), args.timeout - (time.time() - started))
+    finally:
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+        await publish_dispatcher.stop()
+        await vk_client.close()
+        await close_download_session()
+        await bot_module.bot.session.close()
+        transcoder.shutdown()
+        await telegram.stop()
+        await vk.stop()
+    elapsed = time.time() - started
+
+    done = [row for row in rows if row[1] == 'done']
+    latencies = [
+        updated_at - sent_at[os.path.basename(file_path).split('.')[0]]
+        for file_path, state, due_at, updated_at in done
+    ]
+    lateness = [updated_at - due_at for _, _, due_at, updated_at in done]
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+    print()
+    dead = sum(row[1] == 'dead' for row in rows)
+    print(f"Роликов: {len(clips)}, клипов: {len(rows)}, опубликовано: {len(done)}, в dead: {dead}, "
+          f"не завершено: {len(rows) - len(done) - dead}")
+    print(f"Время прогона: {elapsed:.1f} c, пропускная способность: {len(done) / elapsed * 60:.1f} роликов/мин")
+    print(f"Сквозная задержка: p50 {percentile(latencies, 0.5):.2f} c, p99 {percentile(latencies, 0.99):.2f} c")
+    print(f"Опоздание публикации: p50 {percentile(lateness, 0.5):.2f} c, p99 {percentile(lateness, 0.99):.2f} c")
+    print("Этапы (среднее время, число замеров):")
+    for name, histogram in (
+        ('скачивание из Telegram', TG_DOWNLOAD_SECONDS),
+        ('обрезка и нарезка', TRANSCODE_SECONDS),
+        ('video.save', VK_VIDEO_SAVE_SECONDS),
+        ('загрузка файла', VK_UPLOAD_SECONDS),
+        ('wall.post', VK_WALL_POST_SECONDS),
+        ('запросы к базе', DB_QUERY_SECONDS),
+    ):
+        count, total = histogram.totals()
+        print(f"  {name}: {total / count if count else 0:.3f} c, {count}")
+    print(f"Запросов к заглушкам: Telegram {telegram.requests} (ошибок {telegram.errors}), VK {vk.requests} (ошибок {vk.errors})")
+    print(f"Пиковый RSS: бот {self_rss:.0f} МБ, дочерние процессы {children_rss:.0f} МБ")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,5 +1,7 @@
+import os
+import html
+import time
 import logging
-import sqlite3
 import asyncio
 import pytz
 import aiohttp
@@ -7,30 +9,64 @@ import string
 import base64
 import random
 import hashlib
-import moviepy as mp
 
-from typing import Final
+from typing import Any, Awaitable, Callable, Dict, Final, Optional, Union
 from urllib.parse import urlparse, parse_qs
 from aiogram.enums.parse_mode import ParseMode
-from aiogram import Bot, Dispatcher, types
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram import Bot, Dispatcher, BaseMiddleware, types
 from aiogram.fsm.context import FSMContext
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import Command, BaseFilter
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types.inline_keyboard_button import InlineKeyboardButton
 from aiogram.types.inline_keyboard_markup import InlineKeyboardMarkup
 from aiogram.types.bot_command import BotCommand
-from aiohttp import ClientSession
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import ClientSession, web
 from datetime import datetime, timedelta
 
-from env import BOT_TOKEN, CLIENT_ID, CLIENT_SECRET
+from env import (
+    BOT_TOKEN,
+    CLIENT_ID,
+    CLIENT_SECRET,
+    ALBUM_COLLECT_DELAY,
+    ALBUM_DOWNLOAD_CONCURRENCY,
+    BOT_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    MAX_INFLIGHT_UPDATES,
+    METRICS_HOST,
+    METRICS_PORT,
+    TELEGRAM_API_URL,
+    LONG_VIDEO_MODE,
+    TIMEZONE,
+    PUBLISH_POLL_INTERVAL,
+)
 from database import *
 from vk_api_requests import *
+from vk_client import vk_client, VK_ID_URL
+from tg_download import download_telegram_file, close_download_session, DownloadError
+from transcoder import transcoder, TranscodeQueueFull
+from media_cache import media_cache, TRIMMED
+from publish_queue import publish_dispatcher, schedule_batch_publish, requeue_dead_jobs
+from batch_upload import batch_uploader
+from fsm_storage import create_storage
+from workers import start_workers, stop_workers
+from janitor import temp_janitor
+from metrics import start_metrics_server, TG_DOWNLOAD_SECONDS, RETRIES_TOTAL, FAILURES_TOTAL
 
 logging.basicConfig(level=logging.INFO)
 
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+)
+storage = create_storage()
 dp = Dispatcher(storage=storage)
 
 REDIRECT_URL: Final = 'https://oauth.vk.com/blank.html'
@@ -50,19 +86,74 @@ class UploadStates(StatesGroup):
     specifying_video_count = State()
     specifying_publish_time = State()
     waiting_for_videos = State()
-    all_upload = State()
 
 class IsAdmin(BaseFilter):
-    async def __call__(self, message: types.Message) -> bool:
-        conn = sqlite3.connect('bot_database.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT is_admin FROM tg_users WHERE tg_id=?", (message.from_user.id,))
-        result = cursor.fetchone()
-        conn.close()
-        return (result and result[0] == True)
+    async def __call__(self, event: Union[types.Message, types.CallbackQuery]) -> bool:
+        return is_admin(event.from_user.id)
+
+class InflightLimit(BaseMiddleware):
+    """
+    Ограничивает число одновременно обрабатываемых апдейтов, остальные ждут своей очереди.
+    """
+
+    def __init__(self, limit: int):
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: types.TelegramObject, data: Dict[str, Any]) -> Any:
+        async with self._semaphore:
+            return await handler(event, data)
+
+_keyboards = {}
+_background_tasks: set[asyncio.Task] = set()
+
+def get_groups_keyboard(prefix: str) -> Optional[InlineKeyboardMarkup]:
+    """
+    Клавиатура со списком групп, callback_data кнопок - '{prefix}_{group_id}'.
+    Кэшируется до следующего изменения списка групп.
+    """
+    version = groups_version()
+    cached = _keyboards.get(prefix)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    keyboard = None
+    groups = get_vk_groups()
+    if groups:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=group_name, callback_data=f'{prefix}_{group_id}')]
+            for group_id, group_name in groups
+        ])
+    _keyboards[prefix] = (version, keyboard)
+    return keyboard
+
+def get_channels_keyboard(selected: list[int]) -> Optional[InlineKeyboardMarkup]:
+    """
+    Клавиатура выбора групп для публикации: выбранные группы отмечены, внизу - кнопка 'Готово'.
+    """
+    keyboard = get_groups_keyboard('channel')
+    if keyboard is None:
+        return None
+
+    rows = []
+    for row in keyboard.inline_keyboard:
+        button = row[0]
+        if int(button.callback_data.split('_')[1]) in selected:
+            button = InlineKeyboardButton(text=f"✅ {button.text}", callback_data=button.callback_data)
+        rows.append([button])
+    rows.append([InlineKeyboardButton(text="Готово", callback_data='channel_done')])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def format_group_links(group_ids: list[int]) -> str:
+    links = []
+    for group_id in group_ids:
+        group = get_vk_group(group_id)
+        if group is not None:
+            links.append(f"<a href='{html.escape(group.group_link)}'>{html.escape(group.group_name)}</a>")
+    return ', '.join(links)
 
 async def cmd_start(message: types.Message) -> None:
-    add_user_if_not_exists(message.from_user.id, message.from_user.username)
+    await run_db(add_user_if_not_exists, message.from_user.id, message.from_user.username)
     if await IsAdmin()(message):
         await message.answer("Добро пожаловать! Используйте команды, предложенные в меню.")
         return
@@ -74,6 +165,13 @@ async def cmd_add_admin(message: types.Message, state: FSMContext) -> None:
     await message.answer('Чтобы выдать права администратора пользователю, введите его никнейм без @:')
     await state.set_state(FormStates.waiting_username_to_add)
 
+async def cmd_requeue_dead(message: types.Message) -> None:
+    count = await requeue_dead_jobs()
+    if count:
+        await message.answer(f"В очередь публикации возвращено задач: {count}.")
+    else:
+        await message.answer("Нет задач, публикация которых не удалась.")
+
 async def cmd_remove_admin(message: types.Message, state: FSMContext) -> None:
     await message.answer('Чтобы отобрать права администратора у пользователя, введите его никнейм без @:')
     await state.set_state(FormStates.waiting_username_to_remove)
@@ -102,7 +200,7 @@ def generate_auth_url(client_id, redirect_uri, state, code_challenge):
     )
     
 async def exchange_code_for_token(code, device_id, client_id, redirect_uri, code_verifier):
-    token_url = 'https://id.vk.com/oauth2/auth'
+    token_url = f'{VK_ID_URL}/oauth2/auth'
     params = {
         'grant_type': 'authorization_code',
         'code': code,
@@ -112,14 +210,12 @@ async def exchange_code_for_token(code, device_id, client_id, redirect_uri, code
         'code_verifier': code_verifier
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(token_url, data=params) as response:
-            if response.status == 200:
-                return await response.json()
-            else:
-                error_response = await response.json()
-                print(f"Ошибка: {error_response}")
-                return None
+    status, response = await vk_client.post_form(token_url, params)
+    if status == 200:
+        return response
+    else:
+        print(f"Ошибка: {response}")
+        return None
 
 async def cmd_start_auth(message: types.Message, state: FSMContext):
     code_verifier = generate_code_verifier()
@@ -158,100 +254,121 @@ async def process_redirect(message: types.Message, state: FSMContext):
         id_token = tokens.get('id_token')
         
         await message.answer(f"Токен успешно сохранен!")
-        update_token_info(message.from_user.id, access_token, refresh_token, id_token, device_id)
+        await run_db(update_token_info, message.from_user.id, access_token, refresh_token, id_token, device_id, token_expires_at(tokens))
     else:
         await message.answer(f"ошибка при получении токена")
 
 
 async def cmd_delete_group(message: types.Message):
-    groups = get_vk_groups()
+    keyboard = get_groups_keyboard('delete')
     
-    if not groups:
+    if keyboard is None:
         await message.answer("Нет доступных групп для удаления.")
         return
     
-    keyboard = []
-    for group_id, group_name in groups:
-        keyboard.append([InlineKeyboardButton(text=group_name, callback_data=f'delete_{group_id}')])
-    await message.answer("Выберите группу для удаления:", reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
+    await message.answer("Выберите группу для удаления:", reply_markup=keyboard)
 
 async def cmd_edit_group_description(message: types.Message):
-    groups = get_vk_groups()  
+    keyboard = get_groups_keyboard('edit')
     
-    if not groups:
+    if keyboard is None:
         await message.answer("Нет доступных групп для редактирования.")
         return
-    
-    keyboard = []
-    for group_id, group_name in groups:
-        keyboard.append([InlineKeyboardButton(text=group_name, callback_data=f'edit_{group_id}')])
 
-    await message.answer("Выберите группу для редактирования:", reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
+    await message.answer("Выберите группу для редактирования:", reply_markup=keyboard)
 
 async def cmd_add_group(message: types.Message, state: FSMContext):
     await state.set_state(FormStates.add_group_link)
-    await message.answer("Пожалуйста, введите ссылку на группу ВК:")
+    await message.answer("Пожалуйста, введите ссылку на группу ВК (можно несколько ссылок в одном сообщении):")
     return
 
 async def cmd_upload(message: types.Message, state: FSMContext):
-    groups = get_vk_groups() 
+    keyboard = get_channels_keyboard([])
     
-    if not groups:
+    if keyboard is None:
         await message.answer("Нет доступных групп для загрузки видео.")
         return
     
-    keyboard = []
-    for group_id, group_name in groups:
-        keyboard.append([InlineKeyboardButton(text=group_name, callback_data=f'channel_{group_id}')])
-    
-    await message.answer("Выберите канал:", reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
+    await message.answer(
+        "Выберите каналы (видео загрузится в VK один раз и будет опубликовано в каждом) и нажмите «Готово»:",
+        reply_markup=keyboard
+    )
     await state.set_state(UploadStates.choosing_channel)
+    await state.update_data(group_ids=[])
     return
 
 async def process_add_admin(message: types.Message, state: FSMContext) -> None:
     try:    
-        set_user_admin(message.text)
-        message.answer('Пользователь успешно добавлен в администраторы!')
+        await run_db(set_user_admin, message.text)
+        await message.answer('Пользователь успешно добавлен в администраторы!')
         await state.clear()
     except Exception as e:  
         await message.answer('Пользователь с таким ником не найден')
 
 async def process_remove_admin(message: types.Message, state: FSMContext) -> None:
     try:    
-        revoke_admin_rights(message.text)
+        await run_db(revoke_admin_rights, message.text)
         await message.answer('Пользователь успешно удален из администраторов!')
         await state.clear()
     except Exception as e:  
         await message.answer('Пользователь с таким ником не найден')
 
 async def process_group_link(message: types.Message, state: FSMContext):
-    link = message.text
-    group_name, group_id = get_group_name_and_id(group_link=link, access_token=get_token_by_tg_id(message.from_user.id))
-    
-    if group_id is None:
-        await message.answer("Не удалось получить ID группы. Убедитесь, что ссылка правильная.")
+    links = parse_group_links(message.text or '')
+    if not links:
+        await message.answer("Не удалось найти ссылку на группу ВК. Убедитесь, что ссылка правильная.")
         return
 
-    await state.update_data(group_link=link, group_name=group_name, group_id=group_id)
-    await state.set_state(FormStates.add_group_description)
-    await message.answer("Введите описание, которым надо будет дополнять видео, публикуемые в этой группе:")
+    access_token = await run_db(get_token_by_tg_id, message.from_user.id)
+    resolved = await resolve_groups([screen_name for _, screen_name in links], access_token)
+
+    groups, failed, existing = [], [], []
+    for link, screen_name in links:
+        if screen_name not in resolved:
+            failed.append(link)
+            continue
+        group_id, group_name = resolved[screen_name]
+        if get_vk_group(group_id) is not None or any(group[2] == group_id for group in groups):
+            existing.append(link)
+        else:
+            groups.append((link, group_name, group_id))
+
+    report = ''
+    if failed:
+        report += "Не удалось получить ID групп:\n" + '\n'.join(failed) + '\n'
+    if existing:
+        report += "Уже добавлены:\n" + '\n'.join(existing) + '\n'
+    if not groups:
+        await message.answer(report + "Нет новых групп для добавления.")
+        return
 
-    await state.update_data(group_link=link, group_name=group_name, group_id=group_id)
+    await state.update_data(groups=groups)
     await state.set_state(FormStates.add_group_description)
-    await message.answer("Введите описание, которым надо будет дополнять видео, публикуемые в этой группе:")
+    if len(groups) == 1:
+        await message.answer(report + "Введите описание, которым надо будет дополнять видео, публикуемые в этой группе:")
+    else:
+        await message.answer(
+            report + f"Будет добавлено групп: {len(groups)}.\n"
+            "Введите описание, которым надо будет дополнять видео, публикуемые в этих группах:"
+        )
 
 async def process_group_description(message: types.Message, state: FSMContext):
     description = message.text.strip()
     user_data = await state.get_data()
-    save_vk_group(group_name=user_data['group_name'], group_link=user_data['group_link'], description=description, group_id=user_data['group_id'])
-    await message.answer(f"Группа успешно добавлена:\nСсылка: {user_data['group_link']}\nОписание: {description}")
+    groups = user_data['groups']
+    await run_db(save_vk_groups, [(link, group_name, description, group_id) for link, group_name, group_id in groups])
+    if len(groups) == 1:
+        await message.answer(f"Группа успешно добавлена:\nСсылка: {groups[0][0]}\nОписание: {description}")
+    else:
+        links = '\n'.join(link for link, _, _ in groups)
+        await message.answer(f"Группы успешно добавлены ({len(groups)}):\n{links}\nОписание: {description}")
     await state.clear()
 
 async def process_delete_group(callback_query: types.CallbackQuery):
     group_id = int(callback_query.data.split('_')[1])
     group_name = get_vk_group_id_by_name(group_id)
     
-    if delete_vk_group(group_id):
+    if await run_db(delete_vk_group, group_id):
         await bot.answer_callback_query(callback_query.id) 
         await bot.send_message(callback_query.from_user.id, f"Группа {group_name} успешно удалена.")
     else:
@@ -273,22 +390,42 @@ async def handle_new_description(message: types.Message, state: FSMContext):
         group_id = user_data['group_id']
         new_description = message.text
         
-        if update_group_description(group_id, new_description):
+        if await run_db(update_group_description, group_id, new_description):
             await message.answer(f"Описание группы с ID {group_id} успешно обновлено.")
             await state.clear()
         else:
             await message.answer("Произошла ошибка при обновлении описания группы.")
 
 async def process_channel_selection(callback_query: types.CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    group_ids = [group_id for group_id in data.get('group_ids', []) if get_vk_group(group_id) is not None]
+
+    if callback_query.data == 'channel_done':
+        if not group_ids:
+            await bot.answer_callback_query(callback_query.id, "Выберите хотя бы одну группу.")
+            return
+        await state.update_data(group_ids=group_ids)
+        await bot.answer_callback_query(callback_query.id)
+        await bot.send_message(callback_query.from_user.id, "Сколько видео хотите опубликовать?")
+        await state.set_state(UploadStates.specifying_video_count)
+        return
+
     group_id = int(callback_query.data.split('_')[1])  
-    group_name = get_vk_group_id_by_name(group_id)
-    group_link = get_group_link(group_id)
-    await state.update_data(group_id=group_id, group_name=group_name, group_link=group_link)  
-    
+    if get_vk_group(group_id) is None:
+        await bot.answer_callback_query(callback_query.id, "Группа не найдена.")
+        return
+
+    if group_id in group_ids:
+        group_ids.remove(group_id)
+    else:
+        group_ids.append(group_id)
+    await state.update_data(group_ids=group_ids)
+
     await bot.answer_callback_query(callback_query.id) 
-    await bot.send_message(callback_query.from_user.id, "Сколько видео хотите опубликовать?")
-    
-    await state.set_state(UploadStates.specifying_video_count)
+    try:
+        await callback_query.message.edit_reply_markup(reply_markup=get_channels_keyboard(group_ids))
+    except TelegramBadRequest:
+        pass
 
 async def process_video_count(message: types.Message, state: FSMContext):
     if not message.text.isdigit() or int(message.text) <= 0:
@@ -333,138 +470,311 @@ async def process_publish_time(message: types.Message, state: FSMContext):
 
         await message.answer(f"Пожалуйста, отправьте {video_count} видео.")
         
-        await state.update_data(videos=[])
+        await state.update_data(videos=[], received=0)
         await state.set_state(UploadStates.waiting_for_videos)
 
     except ValueError:
         await message.answer("Некорректный формат времени. Пожалуйста, используйте формат 'ДД ЧЧ:ММ' или 'ЧЧ:ММ'.")
 
-async def download_video_with_timeout(video_id, timeout=60):
+async def download_video_with_timeout(video_id, destination, timeout=60):
     """
     Функция для скачивания видео с таймаутом.
+    Недокачанный файл остается на диске, и следующая попытка продолжает с места обрыва.
     """
-    return await asyncio.wait_for(bot.download(video_id), timeout)
+    return await asyncio.wait_for(download_telegram_file(bot, video_id, destination), timeout)
 
-async def process_video(message: types.Message, state: FSMContext):
-    try:
-        video = message.video
-        temp_file_path = f"temp/{video.file_id}.mp4"
-        data = await state.get_data()
-        videos = data.get('videos', [])
-        messages = data.get('messages', [])
-        if os.path.exists(temp_file_path):
-            videos.append(temp_file_path)
-            await state.update_data(videos=videos)
-            return
+_albums: dict[tuple[int, str], list[types.Message]] = {}
+_state_locks: dict[tuple[int, int], asyncio.Lock] = {}
+# file_unique_id -> текущее скачивание оригинала
+_downloads: dict[str, asyncio.Task] = {}
+
+def _state_lock(message: types.Message) -> asyncio.Lock:
+    """
+    Блокировка FSM-состояния пользователя в чате, через нее проходят все изменения списка videos.
+    """
+    key = (message.chat.id, message.from_user.id)
+    lock = _state_locks.get(key)
+    if lock is None:
+        lock = _state_locks[key] = asyncio.Lock()
+    return lock
+
+async def download_original(message: types.Message, video: types.Video) -> Optional[str]:
+    """
+    Возвращает путь к оригиналу видео из кэша, при необходимости скачивая его.
+    Одновременные запросы одного и того же видео ждут одно общее скачивание.
+    Возвращает None, если скачать не удалось (пользователю уже ответили).
+    """
+    source_path = media_cache.lookup(video.file_unique_id)
+    if source_path is not None:
+        return source_path
+
+    unique_id = video.file_unique_id
+    task = _downloads.get(unique_id)
+    if task is None:
+        task = _downloads[unique_id] = asyncio.create_task(fetch_original(video))
+        task.add_done_callback(lambda done: _downloads.pop(unique_id) if _downloads.get(unique_id) is done else None)
+    # shield: отмена одного ожидающего не должна прерывать скачивание для остальных
+    source_path, error = await asyncio.shield(task)
+    if error is not None:
+        await message.reply(error)
+    return source_path
+
+async def fetch_original(video: types.Video) -> tuple[Optional[str], Optional[str]]:
+    """
+    Скачивает оригинал видео в кэш.
+    Возвращает путь к файлу или None и текст ответа пользователю о причине отказа.
+    """
+    reserved = video.file_size or 0
+    if not temp_janitor.reserve(reserved):
+        FAILURES_TOTAL.inc(operation='disk_quota')
+        return None, 'Сейчас на сервере не хватает места для видео, попробуйте отправить его позже.'
 
+    download_path = media_cache.path_for(video.file_unique_id)
+    try:
         attempt = 0
         while attempt < 3:
             try:
-                downloaded = await download_video_with_timeout(video.file_id, timeout=60)
+                with TG_DOWNLOAD_SECONDS.time():
+                    checksum = await download_video_with_timeout(video.file_id, download_path, timeout=60)
                 break
-            except asyncio.TimeoutError:
+            except (asyncio.TimeoutError, aiohttp.ClientError, DownloadError) as e:
                 attempt += 1
-                print(f"Попытка {attempt}: Ошибка таймаута при скачивании видео. Повторная попытка через 5 секунд...")
+                RETRIES_TOTAL.inc(operation='tg_download')
+                print(f"Попытка {attempt}: Ошибка при скачивании видео ({e!r}). Повторная попытка через 5 секунд...")
                 await asyncio.sleep(5)
         else:
-            await message.reply('Не удалось скачать видео после нескольких попыток.')
-            return
-
-        with open(temp_file_path, 'wb') as temp_file:
-            temp_file.write(downloaded.read())
-
-        if video.duration >= 60:
-            video_clip = mp.VideoFileClip(temp_file_path)
-            trimmed_clip: mp.VideoFileClip = video_clip.subclipped(0, 59)
-
-            trimmed_clip.write_videofile(
-                temp_file_path,
-                codec="libx264",
-                audio_codec="aac",
-                fps=video_clip.fps,
-                bitrate="3000k", 
-                ffmpeg_params=["-preset", "ultrafast"]  
-            )
-            trimmed_clip.close()
-            video_clip.close()
-
-        videos.append(temp_file_path)
+            FAILURES_TOTAL.inc(operation='tg_download')
+            return None, 'Не удалось скачать видео после нескольких попыток.'
+    finally:
+        temp_janitor.release(reserved)
+    print(f"Видео {video.file_id} скачано в {download_path}, sha256: {checksum}")
+    return media_cache.add(video.file_unique_id, checksum, download_path), None
+
+async def ingest_video(message: types.Message) -> list[str]:
+    """
+    Скачивает видео из сообщения (или берет из кэша) и закрепляет готовые файлы.
+    Видео длиннее минуты в режиме split режется на клипы по 59 секунд (хвост короче
+    SPLIT_MIN_TAIL_SECONDS отбрасывается), в режиме trim - обрезается.
+    Возвращает пути клипов по порядку или пустой список, если о причине отказа уже сообщено пользователю.
+    """
+    try:
+        video = message.video
+        if video.duration < 60:
+            clip_paths = [await download_original(message, video)]
+        elif LONG_VIDEO_MODE == 'split':
+            clip_paths = media_cache.lookup_segments(video.file_unique_id)
+            if clip_paths is None:
+                clip_paths = await process_long_video(message, video, split=True)
+        else:
+            clip_paths = [media_cache.lookup(video.file_unique_id, TRIMMED)]
+            if clip_paths[0] is None:
+                clip_paths = await process_long_video(message, video, split=False)
 
-        if len(videos) != 0:
-            await state.update_data(videos=videos)
+        if not clip_paths or None in clip_paths:
+            return []
+        for path in clip_paths:
+            media_cache.pin(path)
+        return clip_paths
 
-    except TypeError as e:
+    except (TypeError, AttributeError) as e:
         print(e)
         await message.reply('Неправильный формат видеофайла')
     except Exception as e:
         print(e)
         await message.reply('Произошла ошибка при загрузке, можете попробовать загрузить файл еще раз')
+    return []
 
-    video_count = data.get('video_count')
-        
-    if messages:
-        for msg_id in messages:
-            await bot.delete_message(chat_id=message.chat.id, message_id=msg_id)
-            messages.remove(msg_id)
+async def process_long_video(message: types.Message, video: types.Video, split: bool) -> list[str]:
+    """
+    Режет длинное видео на клипы (split) или обрезает до 59 секунд и регистрирует результат в кэше.
+    """
+    source_path = await download_original(message, video)
+    if source_path is None:
+        return []
 
-    if len(videos) < video_count:
-        remaining_videos = video_count - len(videos)
+    media_cache.pin(source_path)
+    reserved = 0
+    try:
+        # Нарезка или обрезка дает файлы не больше исходника
+        needed = os.path.getsize(source_path)
+        if not temp_janitor.reserve(needed):
+            FAILURES_TOTAL.inc(operation='disk_quota')
+            await message.reply('Сейчас на сервере не хватает места для видео, попробуйте отправить его позже.')
+            return []
+        reserved = needed
+
+        if split:
+            segments = await transcoder.split(source_path, media_cache.segments_template(video.file_unique_id))
+            print(f"Видео {video.file_id} разрезано на {len(segments)} клипов")
+            return media_cache.add_segments(video.file_unique_id, segments)
+
+        trimmed_path = media_cache.path_for(video.file_unique_id, TRIMMED)
+        await transcoder.trim(source_path, trimmed_path)
+        return [media_cache.add_variant(video.file_unique_id, TRIMMED, trimmed_path)]
+    except TranscodeQueueFull:
+        await message.reply('Сейчас обрабатывается слишком много видео, отправьте этот файл чуть позже.')
+        return []
+    finally:
+        temp_janitor.release(reserved)
+        media_cache.unpin(source_path)
+
+async def collect_album(message: types.Message) -> Optional[list[types.Message]]:
+    """
+    Собирает сообщения одного альбома (media_group_id). Первое сообщение ждет,
+    пока в течение ALBUM_COLLECT_DELAY не перестанут приходить новые, и возвращает весь альбом;
+    для остальных сообщений возвращает None.
+    """
+    key = (message.chat.id, message.media_group_id)
+    album = _albums.get(key)
+    if album is not None:
+        album.append(message)
+        return None
+
+    album = _albums[key] = [message]
+    collected = 0
+    while collected != len(album):
+        collected = len(album)
+        await asyncio.sleep(ALBUM_COLLECT_DELAY)
+    del _albums[key]
+    return sorted(album, key=lambda item: item.message_id)
+
+async def process_video(message: types.Message, state: FSMContext):
+    if message.media_group_id is None:
+        album = [message]
+    else:
+        album = await collect_album(message)
+        if album is None:
+            return
+
+    semaphore = asyncio.Semaphore(ALBUM_DOWNLOAD_CONCURRENCY)
+
+    async def ingest(item: types.Message) -> list[str]:
+        async with semaphore:
+            return await ingest_video(item)
+
+    # Клипы каждого принятого сообщения; длинное видео в режиме split дает несколько клипов
+    accepted = [paths for paths in await asyncio.gather(*(ingest(item) for item in album)) if paths]
+
+    async with _state_lock(message):
+        if await state.get_state() != UploadStates.waiting_for_videos.state:
+            for path in (path for paths in accepted for path in paths):
+                media_cache.unpin(path)
+            return
+
+        data = await state.get_data()
+        video_count = data.get('video_count')
+        received = data.get('received', 0)
+        for path in (path for paths in accepted[video_count - received:] for path in paths):
+            media_cache.unpin(path)
+        accepted = accepted[:video_count - received]
+        received += len(accepted)
+        videos = data.get('videos', []) + [path for paths in accepted for path in paths]
+
+        for msg_id in data.get('messages', []):
+            try:
+                await bot.delete_message(chat_id=message.chat.id, message_id=msg_id)
+            except TelegramBadRequest:
+                pass
+        messages = []
 
-        if remaining_videos > 0 and not messages:
-            msg = await message.answer(f"Осталось загрузить {remaining_videos} видео.")
+        if received < video_count:
+            msg = await message.answer(f"Осталось загрузить {video_count - received} видео.")
             messages.append(msg.message_id)
+            await state.update_data(videos=videos, received=received, messages=messages)
+            return
 
-        await state.update_data(messages=messages)
-        return
-    
-    if len(videos) == video_count:
-        msg = await message.answer("Все видео загружены!")
-        await state.set_state(UploadStates.all_upload)
-        await state.update_data(videos=videos)  
-        await upload_all_videos(message, state)
+        if len(videos) > received:
+            await message.answer(f"Все видео загружены! Длинные видео разрезаны, всего клипов: {len(videos)}.")
+        else:
+            await message.answer("Все видео загружены!")
+        # Состояние очищается до первого await вне блокировки, чтобы следующее сообщение
+        # не застало пачку в состоянии ожидания и не поставило ее в очередь второй раз
+        await state.clear()
 
-async def upload_all_videos(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    
-    videos = data.get('videos', [])
-    group_id = data.get('group_id')
-    group_name = data.get('group_name')
-    group_link = data.get('group_link')
-    publish_time = data.get('publish_time')
+    await upload_all_videos(message, videos, data.get('group_ids', []), data.get('publish_time'))
 
+async def upload_all_videos(message: types.Message, videos: list[str], group_ids: list[int],
+                            publish_time: Optional[datetime]):
     if publish_time is None:
         await message.answer("Не указано время публикации.")
         return
 
     publish_time_str = f"{publish_time.day}.{publish_time.month} в {publish_time.hour}:{publish_time.minute}"
     
-    description = get_group_description(group_id)
     user_tg_id = message.from_user.id
+    group_links = format_group_links(group_ids)
 
-    for i, video_path in enumerate(videos):
-        if i > 0 and i % 3 == 0:
-            publish_time += timedelta(seconds=20)
+    jobs = await schedule_batch_publish(
+        group_ids=group_ids,
+        tg_id=user_tg_id,
+        publish_time=publish_time,
+        temp_file_paths=videos
+    )
 
-        await schedule_video_publish(
-            group_id=group_id,
-            tg_id=user_tg_id,
-            publish_time=publish_time,
-            description=description,
-            temp_file_path=video_path
+    if len(group_ids) == 1:
+        last_time = datetime.fromtimestamp(max(job['due_at'] for job in jobs), pytz.timezone(TIMEZONE))
+        await message.answer(
+            f"{len(videos)} видео будет выложено с {publish_time_str} по {last_time:%d.%m %H:%M:%S} в группе {group_links}.",
+            parse_mode=ParseMode.HTML
+        )
+    else:
+        await message.answer(
+            f"{len(videos)} видео будет выложено начиная с {publish_time_str} в группах: {group_links}.\n"
+            "Каждое видео загружается в VK один раз.",
+            parse_mode=ParseMode.HTML
         )
 
-    await state.clear()
-    await message.answer(
-        f"{len(videos)} видео будет выложено начиная с {publish_time_str} в группе <a href='{group_link}'>{group_name}</a>.",
-        parse_mode=ParseMode.HTML
-    )
-
-    yekaterinburg_tz = pytz.timezone('Asia/Yekaterinburg')
-    publish_time_aware = publish_time.replace(tzinfo=yekaterinburg_tz)
+    status = await message.answer(f"Загрузка видео в VK: 0/{len(jobs)}")
+    last_edit = 0.0
 
-    wait_time = (publish_time_aware - datetime.now(yekaterinburg_tz)).total_seconds() - 1800    
-    await asyncio.sleep(wait_time)
-    await message.answer(f"{len(videos)} видео выложено в группе <a href='{group_link}'>{group_name}</a>.", parse_mode=ParseMode.HTML)
+    async def report_progress(uploaded, failed, total):
+        nonlocal last_edit
+        finished = uploaded + failed == total
+        if not finished and time.monotonic() - last_edit < 1:
+            return
+        last_edit = time.monotonic()
+
+        text = f"Загрузка видео в VK: {uploaded}/{total}"
+        if failed:
+            text += f", ошибок: {failed} (будет повторена позже)"
+        if finished:
+            text += "\nЗагрузка завершена."
+        try:
+            await status.edit_text(text)
+        except TelegramBadRequest:
+            pass
+
+    await batch_uploader.upload_batch(jobs, report_progress)
+
+    # Уведомление отправляется отдельной задачей, чтобы обработчик не занимал слот InflightLimit до публикации
+    task = asyncio.create_task(notify_published(message.chat.id, len(videos), group_links, [job['id'] for job in jobs]))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def notify_published(chat_id: int, video_count: int, group_links: str, job_ids: list[int]) -> None:
+    """
+    Ждет, пока все задачи пачки, включая публикации того же видео в других группах,
+    будут выполнены или уйдут в dead, и сообщает итог, в том числе о неудавшихся публикациях.
+    """
+    while True:
+        jobs = await run_db(get_publish_batch_jobs, job_ids)
+        waiting = [due_at for state, due_at in jobs if state not in ('done', 'dead')]
+        if not waiting:
+            break
+        await asyncio.sleep(max(max(waiting) - time.time(), PUBLISH_POLL_INTERVAL))
+
+    dead = sum(state == 'dead' for state, _ in jobs)
+    if dead:
+        text = (
+            f"Выложено {len(jobs) - dead} из {len(jobs)} публикаций в группах: {group_links}.\n"
+            f"Не удалось выложить: {dead}, их можно вернуть в очередь командой /requeue_dead."
+        )
+    else:
+        text = f"{video_count} видео выложено в группах: {group_links}."
+    try:
+        await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
+    except Exception as e:
+        print(f"Не удалось отправить уведомление о публикации в чат {chat_id}: {e!r}")
 
 def register_handlers() -> None:
     dp.message.register(cmd_start, Command('start'))
@@ -475,6 +785,7 @@ def register_handlers() -> None:
     dp.message.register(cmd_upload, Command('upload'), IsAdmin())
     dp.message.register(cmd_add_admin, Command('add_admin'), IsAdmin())
     dp.message.register(cmd_remove_admin, Command('remove_admin'), IsAdmin())
+    dp.message.register(cmd_requeue_dead, Command('requeue_dead'), IsAdmin())
 
     dp.message.register(process_redirect, FormStates.waiting_for_redirect, IsAdmin())
     dp.message.register(process_group_link, FormStates.add_group_link, IsAdmin())
@@ -486,18 +797,66 @@ def register_handlers() -> None:
     dp.message.register(process_video_count, UploadStates.specifying_video_count, IsAdmin())
     dp.message.register(process_publish_time, UploadStates.specifying_publish_time, IsAdmin())
     dp.message.register(process_video, UploadStates.waiting_for_videos, IsAdmin())
-    dp.message.register(upload_all_videos, UploadStates.all_upload, IsAdmin())
 
     dp.callback_query.register(process_delete_group, lambda c: c.data.startswith('delete_'), IsAdmin())
     dp.callback_query.register(process_edit_group_description, lambda c: c.data.startswith('edit_'), IsAdmin())
     dp.callback_query.register(process_channel_selection, UploadStates.choosing_channel, lambda c: c.data.startswith('channel_'), IsAdmin())
 
+async def run_webhook():
+    """
+    Принимает апдейты через вебхук на WEBHOOK_HOST:WEBHOOK_PORT вместо long polling.
+    Запросы без правильного X-Telegram-Bot-Api-Secret-Token отклоняются, апдейты
+    обрабатываются в фоне. Вебхук обслуживает один процесс: альбомы, блокировки состояний,
+    кэши групп и администраторов, календарь публикаций и лимиты запросов хранятся в его памяти,
+    а при запуске процесс сам регистрирует вебхук.
+    """
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    print(f"Вебхук {WEBHOOK_URL}{WEBHOOK_PATH} слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 async def main():
     scheduler.timezone = pytz.timezone('Asia/Yekaterinburg')
     scheduler.add_job(update_access_tokens, 'cron', minute='*')    
     scheduler.start()
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    workers = start_workers()
+    await publish_dispatcher.start(process_jobs=not workers)
+    await temp_janitor.start()
     register_handlers()
-    await dp.start_polling(bot)
+    dp.update.outer_middleware(InflightLimit(MAX_INFLIGHT_UPDATES))
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        for task in _background_tasks:
+            task.cancel()
+        stop_workers(workers)
+        await publish_dispatcher.stop()
+        await temp_janitor.stop()
+        await storage.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await vk_client.close()
+        await close_download_session()
+        transcoder.shutdown()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
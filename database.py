@@ -1,7 +1,63 @@
+import time
 import sqlite3
+import asyncio
+import functools
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from env import DATABASE_PATH
+from metrics import DB_QUERY_SECONDS
+
+_local = threading.local()
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='database')
+# Кэши меняются в потоке базы (run_db), а читаются из цикла событий,
+# поэтому изменения и обход идут под _cache_lock
+_cache_lock = threading.Lock()
+_admin_ids = set()
+_groups = {}
+_groups_version = 0
+
+class GroupRecord:
+    __slots__ = ('group_id', 'group_name', 'group_link', 'description')
+
+    def __init__(self, group_id, group_name, group_link, description):
+        self.group_id = group_id
+        self.group_name = group_name
+        self.group_link = group_link
+        self.description = description
+
+def get_connection():
+    """
+    Возвращает долгоживущее соединение текущего потока.
+    База работает в режиме WAL, поэтому чтения из разных потоков не блокируют запись.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DATABASE_PATH, timeout=30, cached_statements=256)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _local.conn = conn
+    return conn
+
+async def run_db(func, *args, **kwargs):
+    """
+    Выполняет функцию работы с базой в отдельном потоке, не блокируя event loop.
+    """
+    loop = asyncio.get_running_loop()
+    with DB_QUERY_SECONDS.time(query=func.__name__):
+        return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
+def _ensure_column(cursor, table, column, declaration):
+    """
+    Добавляет колонку в таблицу, созданную прошлой версией бота.
+    """
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
 
 def create_db():
-    conn = sqlite3.connect('bot_database.db')
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute('''
@@ -12,10 +68,13 @@ def create_db():
             access_token TEXT,
             refresh_token TEXT,
             token_id TEXT,
-            device_id TEXT
+            device_id TEXT,
+            expires_at INTEGER
         )
     ''')
 
+    _ensure_column(cursor, 'tg_users', 'expires_at', 'INTEGER')
+
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS vk_groups (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -26,42 +85,111 @@ def create_db():
         )
     ''')
 
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS publish_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER NOT NULL,
+            tg_id INTEGER NOT NULL,
+            description TEXT,
+            file_path TEXT NOT NULL,
+            due_at REAL NOT NULL,
+            state TEXT NOT NULL DEFAULT 'new',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL,
+            video_id INTEGER,
+            next_attempt_at REAL,
+            lease_owner TEXT,
+            lease_expires_at REAL,
+            upload_job_id INTEGER,
+            video_owner_id INTEGER,
+            upload_url TEXT,
+            saved_video_id INTEGER
+        )
+    ''')
+    _ensure_column(cursor, 'publish_jobs', 'video_id', 'INTEGER')
+    _ensure_column(cursor, 'publish_jobs', 'next_attempt_at', 'REAL')
+    _ensure_column(cursor, 'publish_jobs', 'lease_owner', 'TEXT')
+    _ensure_column(cursor, 'publish_jobs', 'lease_expires_at', 'REAL')
+    _ensure_column(cursor, 'publish_jobs', 'upload_job_id', 'INTEGER')
+    _ensure_column(cursor, 'publish_jobs', 'video_owner_id', 'INTEGER')
+    _ensure_column(cursor, 'publish_jobs', 'upload_url', 'TEXT')
+    _ensure_column(cursor, 'publish_jobs', 'saved_video_id', 'INTEGER')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS vk_screen_names (
+            screen_name TEXT PRIMARY KEY,
+            group_id INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    _ensure_column(cursor, 'vk_screen_names', 'group_name', 'TEXT')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}'
+        )
+    ''')
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vk_groups_group_id ON vk_groups (group_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tg_users_username ON tg_users (username)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tg_users_is_admin ON tg_users (is_admin)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_publish_jobs_state_due_at ON publish_jobs (state, due_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_publish_jobs_upload_job_id ON publish_jobs (upload_job_id)")
+
     conn.commit()
 
-def get_users():
-    conn = sqlite3.connect('bot_database.db')
+def get_users_with_expiring_tokens(expires_before):
+    """
+    Администраторы, чей access_token истекает раньше expires_before (unix time) или срок которого неизвестен.
+    """
+    conn = get_connection()
     cursor = conn.cursor()
 
-    cursor.execute("SELECT tg_id, refresh_token, device_id FROM tg_users WHERE is_admin = 1")
+    cursor.execute('''
+        SELECT tg_id, refresh_token, device_id FROM tg_users
+        WHERE is_admin = 1 AND refresh_token IS NOT NULL AND (expires_at IS NULL OR expires_at <= ?)
+    ''', (expires_before,))
     return cursor.fetchall()
 
-def get_vk_groups():
-    conn = sqlite3.connect('bot_database.db')
+def load_groups_cache():
+    """
+    Загружает все группы одним запросом. Дальше кэш поддерживают функции, изменяющие vk_groups.
+    """
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT group_id, group_name FROM vk_groups")
-    groups = cursor.fetchall()
-    conn.close()
-    return groups
+    cursor.execute("SELECT group_id, group_name, group_link, description FROM vk_groups ORDER BY id")
+    rows = cursor.fetchall()
+    with _cache_lock:
+        _groups.clear()
+        for row in rows:
+            _groups[row[0]] = GroupRecord(*row)
+        _bump_groups_version()
+
+def _bump_groups_version():
+    global _groups_version
+    _groups_version += 1
+
+def groups_version():
+    return _groups_version
+
+def get_vk_group(group_id):
+    return _groups.get(group_id)
+
+def get_vk_groups():
+    with _cache_lock:
+        groups = list(_groups.values())
+    return [(group.group_id, group.group_name) for group in groups]
 
 def get_vk_group_id_by_name(group_id: str):
-    conn = sqlite3.connect('bot_database.db')
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT group_name FROM vk_groups WHERE group_id = ?", (group_id,))
-        result = cursor.fetchone()  
-        
-        if result:
-            return result[0]       
-        else:
-            return None  
-    except Exception as e:
-        print(f"Произошла ошибка: {e}")
-        return None  
-    finally:
-        conn.close() 
+    group = _groups.get(group_id)
+    return group.group_name if group else None
 
 def add_user_if_not_exists(tg_id, username):
-    conn = sqlite3.connect('bot_database.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute("SELECT * FROM tg_users WHERE tg_id=?", (tg_id,))
@@ -70,62 +198,123 @@ def add_user_if_not_exists(tg_id, username):
     if result is None:
         cursor.execute("INSERT INTO tg_users (tg_id, username) VALUES (?, ?)", (tg_id, username))
         conn.commit()
-    
-    conn.close()
 
-def update_token_info(tg_id, token, refresh_token, token_id, device_id):
-    conn = sqlite3.connect('bot_database.db')
+def load_admin_cache():
+    """
+    Загружает id администраторов в память. Дальше кэш поддерживают set_user_admin и revoke_admin_rights.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT tg_id FROM tg_users WHERE is_admin = 1")
+    rows = cursor.fetchall()
+    with _cache_lock:
+        _admin_ids.clear()
+        _admin_ids.update(row[0] for row in rows)
+
+def is_admin(tg_id):
+    return tg_id in _admin_ids
+
+def _get_tg_ids_by_username(cursor, username):
+    cursor.execute("SELECT tg_id FROM tg_users WHERE username = ?", (username,))
+    return [row[0] for row in cursor.fetchall()]
+
+def update_token_info(tg_id, token, refresh_token, token_id, device_id, expires_at=None):
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
-        cursor.execute("UPDATE tg_users SET access_token = ?, refresh_token = ?, token_id = ?, device_id = ? WHERE tg_id = ?", (token, refresh_token, token_id, device_id, tg_id))
+        cursor.execute("UPDATE tg_users SET access_token = ?, refresh_token = ?, token_id = ?, device_id = ?, expires_at = ? WHERE tg_id = ?", (token, refresh_token, token_id, device_id, expires_at, tg_id))
         conn.commit()  
         return True  
     except Exception as e:
+        conn.rollback()
         print(f"Ошибка при обновлении токена: {e}")
         return False  
-    finally:
-        conn.close()  
 
-def update_token(tg_id, token, r_token):
-    conn = sqlite3.connect('bot_database.db')
+def update_token(tg_id, token, r_token, expires_at=None):
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
-        cursor.execute("UPDATE tg_users SET access_token = ?, refresh_token = ? WHERE tg_id = ?", (token, r_token, tg_id))
+        cursor.execute("UPDATE tg_users SET access_token = ?, refresh_token = ?, expires_at = ? WHERE tg_id = ?", (token, r_token, expires_at, tg_id))
         conn.commit()  
         return True  
     except Exception as e:
+        conn.rollback()
         print(f"Ошибка при обновлении токена: {e}")
         return False  
-    finally:
-        conn.close()  
 
 def save_vk_group(group_link, group_name, description, group_id):
-    conn = sqlite3.connect('bot_database.db')
+    save_vk_groups([(group_link, group_name, description, group_id)])
+
+def save_vk_groups(groups):
+    """
+    Добавляет группы одной транзакцией. groups - кортежи (group_link, group_name, description, group_id).
+    """
+    conn = get_connection()
     cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO vk_groups (group_name, group_link, description, group_id)
-        VALUES (?, ?, ?, ?)
-    ''', (group_name, group_link, description, group_id))
-    
+
+    try:
+        cursor.executemany('''
+            INSERT INTO vk_groups (group_link, group_name, description, group_id)
+            VALUES (?, ?, ?, ?)
+        ''', groups)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    with _cache_lock:
+        for group_link, group_name, description, group_id in groups:
+            _groups[group_id] = GroupRecord(group_id, group_name, group_link, description)
+        _bump_groups_version()
+
+def get_cached_groups(screen_names):
+    """
+    Возвращает сохраненные ранее id и названия групп VK по их коротким именам: {screen_name: (group_id, group_name)}.
+    Записи без названия (сохраненные до появления столбца) не возвращаются.
+    """
+    if not screen_names:
+        return {}
+    conn = get_connection()
+    cursor = conn.cursor()
+    placeholders = ', '.join('?' * len(screen_names))
+    cursor.execute(f'''
+        SELECT screen_name, group_id, group_name FROM vk_screen_names
+        WHERE screen_name IN ({placeholders}) AND group_name IS NOT NULL
+    ''', list(screen_names))
+    return {screen_name: (group_id, group_name) for screen_name, group_id, group_name in cursor.fetchall()}
+
+def cache_groups(groups):
+    """
+    Сохраняет id и названия групп VK по их коротким именам: {screen_name: (group_id, group_name)}.
+    """
+    conn = get_connection()
+    now = time.time()
+    conn.executemany('''
+        INSERT INTO vk_screen_names (screen_name, group_id, group_name, updated_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(screen_name) DO UPDATE SET
+            group_id = excluded.group_id, group_name = excluded.group_name, updated_at = excluded.updated_at
+    ''', [(screen_name, group_id, group_name, now) for screen_name, (group_id, group_name) in groups.items()])
     conn.commit()
-    conn.close()
 
 def set_user_admin(username):
-    conn = sqlite3.connect('bot_database.db')
+    conn = get_connection()
     cursor = conn.cursor()
 
     try:
         cursor.execute("UPDATE tg_users SET is_admin = 1 WHERE username = ?", (username,))
     except Exception as e:
+        conn.rollback()
         raise e
     
     conn.commit()
+    tg_ids = _get_tg_ids_by_username(cursor, username)
+    with _cache_lock:
+        _admin_ids.update(tg_ids)
 
 def revoke_admin_rights(username):
-    conn = sqlite3.connect('bot_database.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -133,17 +322,19 @@ def revoke_admin_rights(username):
         conn.commit()  
         
         if cursor.rowcount > 0:
+            tg_ids = _get_tg_ids_by_username(cursor, username)
+            with _cache_lock:
+                _admin_ids.difference_update(tg_ids)
             print(f"Права администратора успешно отменены для пользователя: {username}")
             return True  
         else:
             raise Exception() 
     except Exception as e:
+        conn.rollback()
         raise e
-    finally:
-        conn.close() 
 
 def get_token_by_tg_id(tg_id):
-    conn = sqlite3.connect('bot_database.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -157,72 +348,403 @@ def get_token_by_tg_id(tg_id):
     except Exception as e:
         print(f"Произошла ошибка: {e}")
         return None  
-    finally:
-        conn.close()  
 
 def delete_vk_group(group_id):
-    conn = sqlite3.connect('bot_database.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
         cursor.execute("DELETE FROM vk_groups WHERE group_id = ?", (group_id,))
         conn.commit()
+        with _cache_lock:
+            _groups.pop(group_id, None)
+            _bump_groups_version()
         return True  
     except Exception as e:
+        conn.rollback()
         print(f"Ошибка при удалении группы: {e}")
         return False  
-    finally:
-        conn.close()
 
 def update_group_description(group_id, new_description):
-    conn = sqlite3.connect('bot_database.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
         cursor.execute("UPDATE vk_groups SET description = ? WHERE group_id = ?", (new_description, group_id))
         conn.commit()
+        with _cache_lock:
+            if group_id in _groups:
+                _groups[group_id].description = new_description
         return True  
     except Exception as e:
+        conn.rollback()
         print(f"Ошибка при обновлении описания группы: {e}")
         return False 
-    finally:
-        conn.close()
 
 def get_group_description(group_id):
-    conn = sqlite3.connect('bot_database.db')
+    group = _groups.get(group_id)
+    return group.description if group else None
+
+def add_publish_jobs(jobs, state='new', owner=None, lease_until=None, crossposts=None):
+    """
+    Добавляет пачку задач (group_id, tg_id, description, file_path, due_at) одной транзакцией и возвращает их строки.
+    Задачи в состоянии uploading сразу арендуются владельцем owner до lease_until.
+    crossposts[i] - список (group_id, description, due_at) групп, где надо опубликовать то же видео,
+    что и в задаче jobs[i]. Такие задачи ждут в состоянии waiting, пока jobs[i] загрузит видео,
+    и в ответ не возвращаются.
+    """
+    conn = get_connection()
     cursor = conn.cursor()
-    
+    cursor.row_factory = sqlite3.Row
+
     try:
-        cursor.execute("SELECT description FROM vk_groups WHERE group_id = ?", (group_id,))
-        result = cursor.fetchone()  
-        
-        if result:
-            return result[0]       
-        else:
-            return None  
-    except Exception as e:
-        print(f"Произошла ошибка: {e}")
-        return None  
-    finally:
-        conn.close() 
+        ids = []
+        now = time.time()
+        for index, (group_id, tg_id, description, file_path, due_at) in enumerate(jobs):
+            cursor.execute('''
+                INSERT INTO publish_jobs (group_id, tg_id, description, file_path, due_at, state, created_at,
+                                          lease_owner, lease_expires_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (group_id, tg_id, description, file_path, due_at, state, now, owner, lease_until))
+            ids.append(cursor.lastrowid)
+            if crossposts:
+                cursor.executemany('''
+                    INSERT INTO publish_jobs (group_id, tg_id, description, file_path, due_at, state, created_at, upload_job_id)
+                    VALUES (?, ?, ?, ?, ?, 'waiting', ?, ?)
+                ''', [
+                    (crosspost_group_id, tg_id, crosspost_description, file_path, crosspost_due_at, now, ids[-1])
+                    for crosspost_group_id, crosspost_description, crosspost_due_at in crossposts[index]
+                ])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    cursor.execute(f"SELECT * FROM publish_jobs WHERE id IN ({','.join('?' * len(ids))}) ORDER BY id", ids)
+    return cursor.fetchall()
 
-def get_group_link(group_id):
-    conn = sqlite3.connect('bot_database.db')
+def _claim_publish_jobs(where, params, new_state, now, limit, owner, lease_until):
+    """
+    Атомарно арендует до limit задач одним UPDATE ... RETURNING, поэтому
+    одну задачу не заберут два процесса, работающие с одной базой.
+    """
+    conn = get_connection()
     cursor = conn.cursor()
-    
+    cursor.row_factory = sqlite3.Row
+
     try:
-        cursor.execute("SELECT group_link FROM vk_groups WHERE group_id = ?", (group_id,))
-        result = cursor.fetchone()  
-        
-        if result:
-            return result[0]       
-        else:
-            return None  
-    except Exception as e:
-        print(f"Произошла ошибка: {e}")
-        return None  
-    finally:
-        conn.close() 
+        cursor.execute(f'''
+            UPDATE publish_jobs
+            SET state = ?, updated_at = ?, lease_owner = ?, lease_expires_at = ?
+            WHERE id IN (
+                SELECT id FROM publish_jobs
+                WHERE {where}
+                ORDER BY due_at
+                LIMIT ?
+            )
+            RETURNING *
+        ''', (new_state, now, owner, lease_until, *params, limit))
+        jobs = cursor.fetchall()
+        conn.commit()
+        return sorted(jobs, key=lambda job: job['due_at'])
+    except Exception:
+        conn.rollback()
+        raise
+
+def claim_due_publish_jobs(now, limit, owner, lease_until):
+    """
+    Переводит до limit задач, время которых наступило, в состояние running и возвращает их.
+    Задачи, видео которых еще не загружено заранее, тоже забираются, как и задачи
+    с истекшей арендой (их владелец завершился, не закончив работу).
+    """
+    return _claim_publish_jobs(
+        "(state IN ('new', 'pending') AND due_at <= ?) OR (state = 'running' AND COALESCE(lease_expires_at, 0) <= ?)",
+        (now, now), 'running', now, limit, owner, lease_until
+    )
+
+def claim_upload_jobs(now, limit, owner, lease_until):
+    """
+    Забирает до limit задач для предварительной загрузки видео, ближайшие по времени публикации - первыми.
+    """
+    return _claim_publish_jobs(
+        "(state = 'new' AND (next_attempt_at IS NULL OR next_attempt_at <= ?))"
+        " OR (state = 'uploading' AND COALESCE(lease_expires_at, 0) <= ?)",
+        (now, now), 'uploading', now, limit, owner, lease_until
+    )
+
+def renew_publish_job_leases(owner, lease_until):
+    """
+    Продлевает аренду всех выполняющихся задач владельца.
+    """
+    conn = get_connection()
+    conn.execute('''
+        UPDATE publish_jobs SET lease_expires_at = ?
+        WHERE lease_owner = ? AND state IN ('running', 'uploading')
+    ''', (lease_until, owner))
+    conn.commit()
+
+def get_publish_job_upload_target(job_id):
+    """
+    Адрес загрузки и id видео, созданного video.save для задачи, или None, если video.save еще не вызывался.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT upload_url, saved_video_id FROM publish_jobs WHERE id = ? AND upload_url IS NOT NULL", (job_id,))
+    return cursor.fetchone()
+
+def set_publish_job_upload_target(job_id, upload_url, video_id):
+    """
+    Запоминает результат video.save, чтобы повторная попытка загрузила файл в то же видео, а не создавала новое.
+    """
+    conn = get_connection()
+    conn.execute("UPDATE publish_jobs SET upload_url = ?, saved_video_id = ? WHERE id = ?", (upload_url, video_id, job_id))
+    conn.commit()
+
+def set_publish_job_video(job_id, video_id):
+    """
+    Сохраняет id загруженного видео. Задача из предварительной загрузки переходит в pending и освобождается.
+    Задачи других групп, ждущие это видео (waiting), получают его id и тоже переходят в pending.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    now = time.time()
+    try:
+        cursor.execute('''
+            UPDATE publish_jobs
+            SET video_id = ?,
+                video_owner_id = -group_id,
+                lease_owner = CASE WHEN state = 'uploading' THEN NULL ELSE lease_owner END,
+                lease_expires_at = CASE WHEN state = 'uploading' THEN NULL ELSE lease_expires_at END,
+                state = CASE WHEN state = 'uploading' THEN 'pending' ELSE state END,
+                updated_at = ?
+            WHERE id = ?
+        ''', (video_id, now, job_id))
+        cursor.execute('''
+            UPDATE publish_jobs
+            SET video_id = ?, video_owner_id = (SELECT -group_id FROM publish_jobs WHERE id = ?),
+                state = 'pending', updated_at = ?
+            WHERE upload_job_id = ? AND state = 'waiting'
+        ''', (video_id, job_id, now, job_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def _fail_waiting_crossposts(cursor, job_id, error):
+    """
+    Переводит в dead задачи других групп, ждавшие видео задачи job_id, которое уже не будет загружено.
+    """
+    cursor.execute('''
+        UPDATE publish_jobs SET state = 'dead', last_error = ?, updated_at = ?
+        WHERE upload_job_id = ? AND state = 'waiting'
+    ''', (error, time.time(), job_id))
+
+def fail_publish_job_upload(job_id, error, retry_at=None):
+    """
+    Записывает ошибку загрузки. С retry_at задача вернется в очередь загрузки, без него - уходит в dead
+    вместе с задачами других групп, ждавшими это видео.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            UPDATE publish_jobs
+            SET state = CASE WHEN ? IS NULL THEN 'dead' ELSE 'new' END,
+                attempts = attempts + 1, last_error = ?, next_attempt_at = ?, updated_at = ?,
+                lease_owner = NULL, lease_expires_at = NULL
+            WHERE id = ? AND state = 'uploading'
+        ''', (retry_at, error, retry_at, time.time(), job_id))
+        if retry_at is None:
+            _fail_waiting_crossposts(cursor, job_id, error)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def postpone_publish_job(job_id, error, retry_at):
+    """
+    Откладывает задачу до retry_at, не считая это попыткой (например, пока VK недоступен).
+    """
+    conn = get_connection()
+    conn.execute('''
+        UPDATE publish_jobs
+        SET state = CASE state WHEN 'uploading' THEN 'new' ELSE 'pending' END,
+            next_attempt_at = CASE state WHEN 'uploading' THEN ? ELSE next_attempt_at END,
+            due_at = CASE state WHEN 'uploading' THEN due_at ELSE MAX(due_at, ?) END,
+            last_error = ?, updated_at = ?, lease_owner = NULL, lease_expires_at = NULL
+        WHERE id = ? AND state IN ('uploading', 'running')
+    ''', (retry_at, retry_at, error, time.time(), job_id))
+    conn.commit()
+
+def requeue_dead_publish_jobs():
+    """
+    Возвращает задачи из dead в очередь с обнуленным счетчиком попыток.
+    Отдает число задач и пути файлов тех из них, видео которых еще предстоит загрузить.
+    Задачи других групп без видео снова ждут загрузки в задаче, от которой зависят.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    now = time.time()
+    try:
+        cursor.execute("SELECT file_path FROM publish_jobs WHERE state = 'dead' AND video_id IS NULL AND upload_job_id IS NULL")
+        file_paths = [row[0] for row in cursor.fetchall()]
+        cursor.execute('''
+            UPDATE publish_jobs
+            SET state = CASE
+                    WHEN video_id IS NOT NULL THEN 'pending'
+                    WHEN upload_job_id IS NOT NULL THEN 'waiting'
+                    ELSE 'new'
+                END,
+                attempts = 0, next_attempt_at = NULL, due_at = MAX(due_at, ?), updated_at = ?
+            WHERE state = 'dead'
+        ''', (now, now))
+        conn.commit()
+        return cursor.rowcount, file_paths
+    except Exception:
+        conn.rollback()
+        raise
+
+def finish_publish_job(job_id):
+    conn = get_connection()
+    conn.execute('''
+        UPDATE publish_jobs SET state = 'done', last_error = NULL, updated_at = ?, lease_owner = NULL, lease_expires_at = NULL
+        WHERE id = ?
+    ''', (time.time(), job_id))
+    conn.commit()
+
+def fail_publish_job(job_id, error, retry_at=None):
+    """
+    Записывает ошибку задачи. С retry_at задача вернется в очередь к этому времени, без него - уходит в dead (dead-letter)
+    вместе с задачами других групп, ждавшими ее видео.
+    """
+    conn = get_connection()
+    if retry_at is None:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE publish_jobs SET state = 'dead', attempts = attempts + 1, last_error = ?, updated_at = ?,
+                                    lease_owner = NULL, lease_expires_at = NULL
+            WHERE id = ?
+        ''', (error, time.time(), job_id))
+        _fail_waiting_crossposts(cursor, job_id, error)
+    else:
+        conn.execute('''
+            UPDATE publish_jobs SET state = 'pending', attempts = attempts + 1, last_error = ?, due_at = ?, updated_at = ?,
+                                    lease_owner = NULL, lease_expires_at = NULL
+            WHERE id = ?
+        ''', (error, retry_at, time.time(), job_id))
+    conn.commit()
+
+def get_next_publish_due_at():
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT MIN(CASE WHEN state = 'running' THEN COALESCE(lease_expires_at, 0) ELSE due_at END)
+        FROM publish_jobs WHERE state IN ('new', 'pending', 'running')
+    ''')
+    return cursor.fetchone()[0]
+
+def get_next_upload_attempt_at():
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT MIN(COALESCE(CASE WHEN state = 'uploading' THEN lease_expires_at ELSE next_attempt_at END, 0))
+        FROM publish_jobs WHERE state IN ('new', 'uploading')
+    ''')
+    return cursor.fetchone()[0]
+
+def recover_publish_jobs(owner, now):
+    """
+    Возвращает в очередь задачи, прерванные остановкой этого процесса (аренда на owner),
+    и задачи любых владельцев, аренда которых истекла к моменту now.
+    Отдает пути файлов, которые еще нужны для загрузки.
+    Задачи с действующей арендой другого владельца не трогаются, поэтому owner должен быть
+    уникален среди живых процессов.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE publish_jobs SET state = 'pending', lease_owner = NULL, lease_expires_at = NULL
+        WHERE state = 'running' AND (lease_owner = ? OR COALESCE(lease_expires_at, 0) <= ?)
+    ''', (owner, now))
+    cursor.execute('''
+        UPDATE publish_jobs SET state = 'new', lease_owner = NULL, lease_expires_at = NULL
+        WHERE state = 'uploading' AND (lease_owner = ? OR COALESCE(lease_expires_at, 0) <= ?)
+    ''', (owner, now))
+    conn.commit()
+    cursor.execute("SELECT file_path FROM publish_jobs WHERE state IN ('new', 'uploading', 'pending') AND video_id IS NULL")
+    return [row[0] for row in cursor.fetchall()]
+
+def get_scheduled_publish_slots(since):
+    """
+    Группа, администратор и время публикации незавершенных задач, назначенных не раньше since.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT group_id, tg_id, due_at FROM publish_jobs
+        WHERE state IN ('new', 'uploading', 'waiting', 'pending', 'running') AND due_at >= ?
+    ''', (since,))
+    return cursor.fetchall()
+
+def get_active_job_file_paths():
+    """
+    Пути файлов, которые еще нужны незавершенным задачам публикации (видео не загружено в VK).
+    Файлы задач из dead не учитываются: при нехватке места они удаляются первыми.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT DISTINCT file_path FROM publish_jobs
+        WHERE state IN ('new', 'uploading', 'waiting', 'pending', 'running') AND video_id IS NULL
+    ''')
+    return [row[0] for row in cursor.fetchall()]
+
+def get_publish_batch_jobs(job_ids):
+    """
+    Состояния и время публикации задач job_ids и задач других групп, публикующих их видео: [(state, due_at)].
+    """
+    if not job_ids:
+        return []
+    conn = get_connection()
+    cursor = conn.cursor()
+    placeholders = ', '.join('?' * len(job_ids))
+    cursor.execute(f'''
+        SELECT state, due_at FROM publish_jobs
+        WHERE id IN ({placeholders}) OR upload_job_id IN ({placeholders})
+    ''', [*job_ids, *job_ids])
+    return cursor.fetchall()
+
+def count_publish_jobs_by_state():
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT state, COUNT(*) FROM publish_jobs WHERE state != 'done' GROUP BY state")
+    return cursor.fetchall()
+
+def get_fsm_record(key):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT state, data FROM fsm_states WHERE key = ?", (key,))
+    return cursor.fetchone()
+
+def set_fsm_state(key, state):
+    conn = get_connection()
+    conn.execute('''
+        INSERT INTO fsm_states (key, state) VALUES (?, ?)
+        ON CONFLICT (key) DO UPDATE SET state = excluded.state
+    ''', (key, state))
+    conn.execute("DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+    conn.commit()
+
+def set_fsm_data(key, data):
+    conn = get_connection()
+    conn.execute('''
+        INSERT INTO fsm_states (key, data) VALUES (?, ?)
+        ON CONFLICT (key) DO UPDATE SET data = excluded.data
+    ''', (key, data))
+    conn.execute("DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+    conn.commit()
 
 create_db()
+load_admin_cache()
+load_groups_cache()
 set_user_admin('dezot01')
\ No newline at end of file
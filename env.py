@@ -2,6 +2,8 @@ from typing import Final
 
 from dotenv import load_dotenv
 import os
+import socket
+import hashlib
 
 
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
@@ -11,4 +13,63 @@ if os.path.exists(dotenv_path):
 
 BOT_TOKEN: Final = os.environ.get('BOT_TOKEN', 'define me!')
 CLIENT_ID: Final =  os.environ.get('CLIENT_ID', 'define me!')
-CLIENT_SECRET: Final = os.environ.get('CLIENT_SECRET', 'define me!')
\ No newline at end of file
+CLIENT_SECRET: Final = os.environ.get('CLIENT_SECRET', 'define me!')
+VK_CONNECTION_LIMIT: Final = int(os.environ.get('VK_CONNECTION_LIMIT', 100))
+VK_CONNECTION_LIMIT_PER_HOST: Final = int(os.environ.get('VK_CONNECTION_LIMIT_PER_HOST', 20))
+VK_KEEPALIVE_TIMEOUT: Final = float(os.environ.get('VK_KEEPALIVE_TIMEOUT', 60))
+VK_DNS_CACHE_TTL: Final = int(os.environ.get('VK_DNS_CACHE_TTL', 300))
+VK_CONNECT_TIMEOUT: Final = float(os.environ.get('VK_CONNECT_TIMEOUT', 10))
+VK_REQUEST_TIMEOUT: Final = float(os.environ.get('VK_REQUEST_TIMEOUT', 60))
+VK_UPLOAD_TIMEOUT: Final = float(os.environ.get('VK_UPLOAD_TIMEOUT', 600))
+VK_UPLOAD_CHUNK_SIZE: Final = int(os.environ.get('VK_UPLOAD_CHUNK_SIZE', 5 * 1024 * 1024))
+VK_UPLOAD_CHUNK_RETRIES: Final = int(os.environ.get('VK_UPLOAD_CHUNK_RETRIES', 3))
+TG_DOWNLOAD_CHUNK_SIZE: Final = int(os.environ.get('TG_DOWNLOAD_CHUNK_SIZE', 256 * 1024))
+TRANSCODE_WORKERS: Final = int(os.environ.get('TRANSCODE_WORKERS', os.cpu_count() or 1))
+TRANSCODE_QUEUE_SIZE: Final = int(os.environ.get('TRANSCODE_QUEUE_SIZE', 20))
+FFPROBE_BINARY: Final = os.environ.get('FFPROBE_BINARY', 'ffprobe')
+PROBE_CACHE_SIZE: Final = int(os.environ.get('PROBE_CACHE_SIZE', 256))
+MEDIA_CACHE_DIR: Final = os.environ.get('MEDIA_CACHE_DIR', 'temp')
+MEDIA_CACHE_MAX_BYTES: Final = int(os.environ.get('MEDIA_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+DATABASE_PATH: Final = os.environ.get('DATABASE_PATH', 'bot_database.db')
+TOKEN_REFRESH_MARGIN: Final = int(os.environ.get('TOKEN_REFRESH_MARGIN', 300))
+TOKEN_REFRESH_CONCURRENCY: Final = int(os.environ.get('TOKEN_REFRESH_CONCURRENCY', 10))
+TOKEN_REFRESH_MAX_BACKOFF: Final = int(os.environ.get('TOKEN_REFRESH_MAX_BACKOFF', 3600))
+TIMEZONE: Final = os.environ.get('TIMEZONE', 'Asia/Yekaterinburg')
+PUBLISH_CONCURRENCY: Final = int(os.environ.get('PUBLISH_CONCURRENCY', 5))
+PUBLISH_POLL_INTERVAL: Final = float(os.environ.get('PUBLISH_POLL_INTERVAL', 5))
+PUBLISH_MAX_ATTEMPTS: Final = int(os.environ.get('PUBLISH_MAX_ATTEMPTS', 5))
+PREUPLOAD_CONCURRENCY: Final = int(os.environ.get('PREUPLOAD_CONCURRENCY', 3))
+VK_RATE_LIMIT: Final = float(os.environ.get('VK_RATE_LIMIT', 3))
+VK_EXECUTE_BATCH_SIZE: Final = int(os.environ.get('VK_EXECUTE_BATCH_SIZE', 25))
+VK_BATCH_WINDOW: Final = float(os.environ.get('VK_BATCH_WINDOW', 0.05))
+UPLOAD_GLOBAL_CONCURRENCY: Final = int(os.environ.get('UPLOAD_GLOBAL_CONCURRENCY', 6))
+UPLOAD_GROUP_CONCURRENCY: Final = int(os.environ.get('UPLOAD_GROUP_CONCURRENCY', 3))
+ALBUM_COLLECT_DELAY: Final = float(os.environ.get('ALBUM_COLLECT_DELAY', 1.0))
+ALBUM_DOWNLOAD_CONCURRENCY: Final = int(os.environ.get('ALBUM_DOWNLOAD_CONCURRENCY', 4))
+FSM_STORAGE: Final = os.environ.get('FSM_STORAGE', 'memory')
+FSM_REDIS_URL: Final = os.environ.get('FSM_REDIS_URL', 'redis://localhost:6379/0')
+WORKER_PROCESSES: Final = int(os.environ.get('WORKER_PROCESSES', 0))
+WORKER_ID: Final = os.environ.get('WORKER_ID', socket.gethostname())
+JOB_LEASE_TIMEOUT: Final = float(os.environ.get('JOB_LEASE_TIMEOUT', 300))
+BOT_MODE: Final = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL: Final = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_PATH: Final = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST: Final = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT: Final = int(os.environ.get('WEBHOOK_PORT', 8080))
+WEBHOOK_SECRET: Final = os.environ.get('WEBHOOK_SECRET', hashlib.sha256(BOT_TOKEN.encode()).hexdigest())
+MAX_INFLIGHT_UPDATES: Final = int(os.environ.get('MAX_INFLIGHT_UPDATES', 100))
+METRICS_HOST: Final = os.environ.get('METRICS_HOST', '0.0.0.0')
+METRICS_PORT: Final = int(os.environ.get('METRICS_PORT', 9464))
+VK_API_URL: Final = os.environ.get('VK_API_URL', 'https://api.vk.com/method')
+VK_ID_URL: Final = os.environ.get('VK_ID_URL', 'https://id.vk.com')
+TELEGRAM_API_URL: Final = os.environ.get('TELEGRAM_API_URL', '')
+CIRCUIT_FAILURE_THRESHOLD: Final = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_TIMEOUT: Final = float(os.environ.get('CIRCUIT_RESET_TIMEOUT', 60))
+LONG_VIDEO_MODE: Final = os.environ.get('LONG_VIDEO_MODE', 'split')
+SPLIT_MIN_TAIL_SECONDS: Final = float(os.environ.get('SPLIT_MIN_TAIL_SECONDS', 5))
+TEMP_DISK_QUOTA_BYTES: Final = int(os.environ.get('TEMP_DISK_QUOTA_BYTES', 4 * 1024 ** 3))
+TEMP_MIN_FREE_BYTES: Final = int(os.environ.get('TEMP_MIN_FREE_BYTES', 1024 ** 3))
+TEMP_SWEEP_INTERVAL: Final = float(os.environ.get('TEMP_SWEEP_INTERVAL', 600))
+TEMP_ORPHAN_GRACE: Final = float(os.environ.get('TEMP_ORPHAN_GRACE', 3600))
+PUBLISH_GROUP_SPACING: Final = float(os.environ.get('PUBLISH_GROUP_SPACING', 7))
+PUBLISH_TOKEN_SPACING: Final = float(os.environ.get('PUBLISH_TOKEN_SPACING', 2))
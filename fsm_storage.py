@@ -0,0 +1,73 @@
+import json
+
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from env import FSM_STORAGE, FSM_REDIS_URL
+from database import *
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError(f"Значение типа {type(value).__name__} нельзя сохранить в состоянии FSM")
+
+
+def _decode(value: dict) -> Any:
+    if '__datetime__' in value:
+        return datetime.fromisoformat(value['__datetime__'])
+    return value
+
+
+def dumps(data: Dict[str, Any]) -> str:
+    return json.dumps(data, default=_encode)
+
+
+def loads(raw: str) -> Dict[str, Any]:
+    return json.loads(raw, object_hook=_decode)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM в таблице fsm_states базы бота. Состояние общее для всех
+    процессов, работающих с одним файлом базы, и переживает перезапуск.
+    Данные хранятся в JSON, datetime сохраняется как строка ISO 8601.
+    """
+
+    def __init__(self):
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await run_db(set_fsm_state, self.key_builder.build(key), state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await run_db(get_fsm_record, self.key_builder.build(key))
+        return record[0] if record else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await run_db(set_fsm_data, self.key_builder.build(key), dumps(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await run_db(get_fsm_record, self.key_builder.build(key))
+        return loads(record[1]) if record else {}
+
+    async def close(self) -> None:
+        pass
+
+
+def create_storage(kind: str = FSM_STORAGE) -> BaseStorage:
+    """
+    Создает хранилище FSM по имени: memory (один процесс), sqlite или redis (нужен пакет redis).
+    """
+    if kind == 'memory':
+        return MemoryStorage()
+    if kind == 'sqlite':
+        return SQLiteStorage()
+    if kind == 'redis':
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(FSM_REDIS_URL, json_dumps=dumps, json_loads=loads)
+    raise ValueError(f"Неизвестное хранилище FSM: {kind}")
@@ -0,0 +1,145 @@
+import os
+import time
+import shutil
+import asyncio
+
+from typing import Optional
+
+from env import TEMP_DISK_QUOTA_BYTES, TEMP_MIN_FREE_BYTES, TEMP_SWEEP_INTERVAL, TEMP_ORPHAN_GRACE
+from database import *
+from media_cache import media_cache, MediaCache
+from metrics import registry, TEMP_BYTES
+
+
+class TempJanitor:
+    """
+    Следит за каталогом временных файлов (кэш видео).
+    Файлы, нужные незавершенным задачам публикации, берутся из базы и не удаляются.
+    Файлы, которых нет в индексе кэша (недокачанные .part, остатки обрезки и нарезки
+    после сбоя), удаляются при запуске и затем раз в interval секунд, если не менялись
+    дольше orphan_grace секунд. Перед новым скачиванием или перекодированием reserve
+    проверяет квоту каталога и свободное место на диске с учетом уже зарезервированных,
+    но еще не записанных байт; по окончании записи резерв возвращается через release.
+    """
+
+    def __init__(self, cache: MediaCache = media_cache,
+                 quota_bytes: int = TEMP_DISK_QUOTA_BYTES,
+                 min_free_bytes: int = TEMP_MIN_FREE_BYTES,
+                 interval: float = TEMP_SWEEP_INTERVAL,
+                 orphan_grace: float = TEMP_ORPHAN_GRACE):
+        self.cache = cache
+        self.quota_bytes = quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self.interval = interval
+        self.orphan_grace = orphan_grace
+        self._task: Optional[asyncio.Task] = None
+        self._reserved = 0
+
+    async def start(self) -> None:
+        """
+        Сразу удаляет все файлы-сироты прошлого запуска и запускает периодическую уборку.
+        """
+        await self.sweep(orphan_grace=0)
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.cache.flush()
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Ошибка уборки временных файлов: {e!r}")
+
+    def _files(self) -> list[os.DirEntry]:
+        with os.scandir(self.cache.root) as entries:
+            return [entry for entry in entries if entry.is_file(follow_symlinks=False)]
+
+    def usage(self) -> int:
+        return sum(entry.stat().st_size for entry in self._files())
+
+    def remove_orphans(self, orphan_grace: Optional[float] = None) -> int:
+        """
+        Удаляет файлы каталога, которых нет в индексе кэша и которые не менялись orphan_grace секунд.
+        Возвращает число освобожденных байт.
+        """
+        orphan_grace = self.orphan_grace if orphan_grace is None else orphan_grace
+        tracked = {os.path.abspath(path) for path in self.cache.tracked_paths()}
+        deadline = time.time() - orphan_grace
+        freed = 0
+        for entry in self._files():
+            if os.path.abspath(entry.path) in tracked:
+                continue
+            stat = entry.stat()
+            if stat.st_mtime > deadline:
+                continue
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            freed += stat.st_size
+            print(f"Удален временный файл-сирота {entry.path}")
+        return freed
+
+    async def sweep(self, orphan_grace: Optional[float] = None) -> int:
+        """
+        Обновляет список файлов задач публикации, удаляет сирот и лишние записи кэша
+        и записывает накопившиеся отметки об использовании в индекс кэша.
+        Возвращает число освобожденных байт.
+        """
+        self.cache.set_job_paths(await run_db(get_active_job_file_paths))
+        freed = self.remove_orphans(orphan_grace)
+        freed += self.cache.release(self.cache.total_bytes - self.cache.max_bytes)
+        self.cache.flush()
+        return freed
+
+    @property
+    def reserved(self) -> int:
+        return self._reserved
+
+    def _shortage(self, needed: int) -> int:
+        # Резерв считается поверх уже записанного: пока файл пишется, его байты учитываются дважды
+        needed += self._reserved
+        over_quota = self.usage() + needed - self.quota_bytes
+        under_free = self.min_free_bytes + needed - shutil.disk_usage(self.cache.root).free
+        return max(over_quota, under_free, 0)
+
+    def reserve(self, needed: int) -> bool:
+        """
+        Проверяет, что в каталоге можно разместить еще needed байт, не выходя за квоту
+        и не опуская свободное место на диске ниже min_free_bytes. При нехватке сначала
+        освобождает давно не использованные незакрепленные записи кэша.
+        """
+        shortage = self._shortage(needed)
+        if shortage and self.cache.release(shortage):
+            shortage = self._shortage(needed)
+        if shortage:
+            print(f"Не хватает {shortage} байт во временном каталоге для файла размером {needed}")
+            return False
+        self._reserved += needed
+        return True
+
+    def release(self, nbytes: int) -> None:
+        """
+        Возвращает резерв, взятый reserve, когда запись файла закончилась (успешно или нет).
+        """
+        self._reserved = max(self._reserved - nbytes, 0)
+
+
+temp_janitor = TempJanitor()
+
+
+async def _collect_temp_metrics() -> None:
+    TEMP_BYTES.set(temp_janitor.usage(), kind='used')
+    TEMP_BYTES.set(temp_janitor.quota_bytes, kind='quota')
+    TEMP_BYTES.set(temp_janitor.reserved, kind='reserved')
+    TEMP_BYTES.set(shutil.disk_usage(temp_janitor.cache.root).free, kind='free')
+
+
+registry.add_collector(_collect_temp_metrics)
@@ -0,0 +1,244 @@
+import os
+import json
+import time
+
+from collections import OrderedDict, Counter
+from typing import Optional
+
+from env import MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES
+
+ORIGINAL = 'original'
+TRIMMED = 'trimmed'
+SEGMENT = 'part'
+
+
+def segment_variant(index: int) -> str:
+    return f'{SEGMENT}{index:03d}'
+
+
+class MediaCache:
+    """
+    Кэш скачанных из Telegram видео и их обработанных вариантов.
+    Ключ записи - file_unique_id, одинаковый для файла во всех чатах;
+    файлы с совпадающим sha256 сводятся к одной записи.
+    Суммарный размер ограничен max_bytes, при превышении удаляются давно
+    не использованные записи, кроме закрепленных за неопубликованными видео:
+    закрепленных в этом процессе через pin и принадлежащих задачам публикации (job_paths).
+    Индекс хранится в index.json рядом с файлами и переживает перезапуск.
+    Изменения состава кэша записываются сразу, а отметки об использовании при попадании
+    в кэш только помечают индекс измененным и записываются через flush.
+    """
+
+    def __init__(self, root: str = MEDIA_CACHE_DIR, max_bytes: int = MEDIA_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(root, 'index.json')
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._aliases: dict[str, str] = {}
+        self._pins: Counter = Counter()
+        self._job_paths: set[str] = set()
+        self._dirty = False
+        self._load()
+
+    def _load(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as index_file:
+                data = json.load(index_file)
+        except (OSError, ValueError) as e:
+            print(f"Не удалось прочитать индекс кэша {self.index_path}: {e}")
+            return
+
+        entries = sorted(data.get('entries', {}).items(), key=lambda item: item[1]['last_access'])
+        for key, entry in entries:
+            entry['variants'] = {
+                name: variant for name, variant in entry['variants'].items() if os.path.exists(variant['path'])
+            }
+            if entry['variants']:
+                self._entries[key] = entry
+        self._aliases = {
+            alias: key for alias, key in data.get('aliases', {}).items() if key in self._entries
+        }
+
+    def _save(self) -> None:
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as index_file:
+            json.dump({'entries': self._entries, 'aliases': self._aliases}, index_file)
+        os.replace(tmp_path, self.index_path)
+        self._dirty = False
+
+    def flush(self) -> None:
+        """
+        Записывает индекс, если после последней записи менялись только отметки об использовании.
+        """
+        if self._dirty:
+            self._save()
+
+    def _resolve(self, unique_id: str) -> str:
+        return self._aliases.get(unique_id, unique_id)
+
+    @staticmethod
+    def _entry_size(entry: dict) -> int:
+        return sum(variant['size'] for variant in entry['variants'].values())
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self._entry_size(entry) for entry in self._entries.values())
+
+    def path_for(self, unique_id: str, variant: str = ORIGINAL) -> str:
+        if variant == ORIGINAL:
+            return os.path.join(self.root, f"{unique_id}.mp4")
+        return os.path.join(self.root, f"{unique_id}.{variant}.mp4")
+
+    def lookup(self, unique_id: str, variant: str = ORIGINAL) -> Optional[str]:
+        """
+        Возвращает путь к варианту файла, если он есть в кэше, и отмечает запись как использованную.
+        """
+        key = self._resolve(unique_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        if variant not in entry['variants']:
+            return None
+        path = entry['variants'][variant]['path']
+        if not os.path.exists(path):
+            self._drop(key)
+            self._save()
+            return None
+
+        entry['last_access'] = time.time()
+        self._entries.move_to_end(key)
+        self._dirty = True
+        return path
+
+    def add(self, unique_id: str, sha256: str, path: str) -> str:
+        """
+        Регистрирует скачанный оригинал. Если файл с таким же содержимым
+        уже есть в кэше, новая копия удаляется и возвращается путь к старой.
+        """
+        for key, entry in self._entries.items():
+            if key != unique_id and entry['sha256'] == sha256 and ORIGINAL in entry['variants']:
+                os.remove(path)
+                self._aliases[unique_id] = key
+                path = self.lookup(key)
+                self._save()
+                return path
+
+        previous = self._entries.pop(unique_id, None)
+        if previous is not None:
+            for variant in previous['variants'].values():
+                if variant['path'] != path and os.path.exists(variant['path']):
+                    os.remove(variant['path'])
+
+        self._entries[unique_id] = {
+            'sha256': sha256,
+            'last_access': time.time(),
+            'variants': {ORIGINAL: {'path': path, 'size': os.path.getsize(path)}},
+        }
+        self._evict(keep=unique_id)
+        self._save()
+        return path
+
+    def add_variant(self, unique_id: str, variant: str, path: str) -> str:
+        """
+        Регистрирует обработанный вариант файла (например, обрезанный).
+        """
+        key = self._resolve(unique_id)
+        entry = self._entries[key]
+        entry['variants'][variant] = {'path': path, 'size': os.path.getsize(path)}
+        entry['last_access'] = time.time()
+        self._entries.move_to_end(key)
+        self._evict(keep=key)
+        self._save()
+        return path
+
+    def segments_template(self, unique_id: str) -> str:
+        """
+        Шаблон путей сегментов разрезанного видео, %03d - номер сегмента.
+        """
+        return self.path_for(unique_id, f'{SEGMENT}%03d')
+
+    def lookup_segments(self, unique_id: str) -> Optional[list[str]]:
+        """
+        Возвращает пути всех сегментов разрезанного видео по порядку или None, если видео еще не разрезано.
+        """
+        entry = self._entries.get(self._resolve(unique_id))
+        if entry is None:
+            return None
+        names = sorted(name for name in entry['variants'] if name.startswith(SEGMENT))
+        if not names:
+            return None
+        paths = [self.lookup(unique_id, name) for name in names]
+        if None in paths:
+            return None
+        return paths
+
+    def add_segments(self, unique_id: str, paths: list[str]) -> list[str]:
+        for index, path in enumerate(paths):
+            self.add_variant(unique_id, segment_variant(index), path)
+        return paths
+
+    def pin(self, path: str) -> None:
+        """
+        Закрепляет файл за ожидающей публикацией, закрепленные файлы не вытесняются.
+        """
+        self._pins[path] += 1
+
+    def unpin(self, path: str) -> None:
+        if self._pins[path] <= 1:
+            self._pins.pop(path, None)
+        else:
+            self._pins[path] -= 1
+
+    def set_job_paths(self, paths) -> None:
+        """
+        Заменяет набор файлов, которые еще нужны задачам публикации (по данным базы).
+        """
+        self._job_paths = set(paths)
+
+    def is_pinned(self, key: str) -> bool:
+        entry = self._entries[key]
+        return any(
+            variant['path'] in self._pins or variant['path'] in self._job_paths
+            for variant in entry['variants'].values()
+        )
+
+    def tracked_paths(self) -> set[str]:
+        paths = {self.index_path, f"{self.index_path}.tmp"}
+        for entry in self._entries.values():
+            paths.update(variant['path'] for variant in entry['variants'].values())
+        return paths
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        for variant in entry['variants'].values():
+            if os.path.exists(variant['path']):
+                os.remove(variant['path'])
+        self._aliases = {alias: target for alias, target in self._aliases.items() if target != key}
+
+    def release(self, needed: int, keep: Optional[str] = None) -> int:
+        """
+        Удаляет давно не использованные незакрепленные записи, пока не освободит needed байт.
+        Возвращает число освобожденных байт.
+        """
+        freed = 0
+        for key in list(self._entries):
+            if freed >= needed:
+                break
+            if key == keep or self.is_pinned(key):
+                continue
+            freed += self._entry_size(self._entries[key])
+            print(f"Освобождается место в кэше видео, удаляется запись {key}")
+            self._drop(key)
+        if freed:
+            self._save()
+        return freed
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        self.release(self.total_bytes - self.max_bytes, keep)
+
+
+media_cache = MediaCache()
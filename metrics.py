@@ -0,0 +1,182 @@
+import time
+import math
+
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+LATENESS_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: tuple, extra: Optional[tuple] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values: dict[tuple, object] = {}
+        registry.register(self)
+
+    @staticmethod
+    def _key(labels: dict) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for labels, value in sorted(self._values.items()):
+            lines.extend(self._render_value(labels, value))
+        return lines
+
+    def _render_value(self, labels: tuple, value) -> list[str]:
+        return [f'{self.name}{_format_labels(labels)} {_format_value(value)}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def clear(self) -> None:
+        self._values.clear()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, documentation)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                state['buckets'][index] += 1
+                break
+        state['sum'] += value
+        state['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Замеряет время выполнения блока, в том числе завершившегося исключением.
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def totals(self) -> tuple[int, float]:
+        """
+        Число наблюдений и их сумма по всем меткам.
+        """
+        count = sum(state['count'] for state in self._values.values())
+        return count, sum(state['sum'] for state in self._values.values())
+
+    def _render_value(self, labels: tuple, state: dict) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, state['buckets']):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{_format_labels(labels, ("le", _format_value(bound)))} {cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(state["sum"])}')
+        lines.append(f'{self.name}_count{_format_labels(labels)} {state["count"]}')
+        return lines
+
+
+class Registry:
+    """
+    Набор метрик процесса. Перед каждой выдачей вызываются коллекторы,
+    которые обновляют значения, снимаемые по запросу (например, глубину очередей).
+    """
+
+    def __init__(self):
+        self._metrics: list[Metric] = []
+        self._collectors: list[Callable[[], Awaitable[None]]] = []
+
+    def register(self, metric: Metric) -> None:
+        self._metrics.append(metric)
+
+    def add_collector(self, collector: Callable[[], Awaitable[None]]) -> None:
+        self._collectors.append(collector)
+
+    async def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                await collector()
+            except Exception as e:
+                print(f"Ошибка сбора метрик {collector.__name__}: {e!r}")
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+TG_DOWNLOAD_SECONDS = Histogram('vkclips_tg_download_seconds', 'Время скачивания видео из Telegram')
+TRANSCODE_SECONDS = Histogram('vkclips_transcode_seconds', 'Время обрезки видео по способу (copy или reencode)')
+VK_VIDEO_SAVE_SECONDS = Histogram('vkclips_vk_video_save_seconds', 'Время вызова video.save')
+VK_UPLOAD_SECONDS = Histogram('vkclips_vk_upload_seconds', 'Время загрузки файла видео в VK')
+VK_WALL_POST_SECONDS = Histogram('vkclips_vk_wall_post_seconds', 'Время вызова wall.post')
+PUBLISH_LATENESS_SECONDS = Histogram(
+    'vkclips_publish_lateness_seconds', 'Фактическое время публикации минус запланированное', LATENESS_BUCKETS
+)
+DB_QUERY_SECONDS = Histogram('vkclips_db_query_seconds', 'Время выполнения функций работы с базой, включая ожидание потока')
+RETRIES_TOTAL = Counter('vkclips_retries_total', 'Повторные попытки по операциям')
+FAILURES_TOTAL = Counter('vkclips_failures_total', 'Неудачные операции')
+CIRCUIT_OPEN = Gauge('vkclips_circuit_open', 'Разомкнут ли предохранитель эндпоинта VK (1 - да)')
+TEMP_BYTES = Gauge('vkclips_temp_bytes', 'Каталог временных файлов: занято (used), квота (quota), свободно на диске (free), зарезервировано под запись (reserved)')
+QUEUE_DEPTH = Gauge('vkclips_queue_depth', 'Глубина очередей: задачи публикации по состояниям и очередь перекодирования')
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    body = (await registry.render()).encode('utf-8')
+    return web.Response(body=body, headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def start_metrics_server(host: str, port: int) -> Optional[web.AppRunner]:
+    """
+    Запускает HTTP-сервер с метриками в формате Prometheus на /metrics. При port == 0 не делает ничего.
+    """
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
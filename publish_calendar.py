@@ -0,0 +1,107 @@
+import time
+import asyncio
+
+from bisect import bisect_left, insort
+from typing import Iterable
+
+from env import PUBLISH_GROUP_SPACING, PUBLISH_TOKEN_SPACING
+from database import *
+
+# Допуск при сравнении времен: busy + spacing - spacing может оказаться чуть меньше busy
+EPSILON = 1e-6
+
+
+class PublishCalendar:
+    """
+    Календарь занятых моментов публикации по группам и по администраторам (токенам).
+    Для каждого ключа хранится отсортированный список времен, поэтому проверка
+    слота - это бинарный поиск. Слот свободен, если в группе нет других постов ближе
+    group_spacing секунд, а у того же токена - ближе token_spacing секунд.
+    Пачки разных администраторов в одну группу чередуются, а не выходят разом.
+    Календарь заполняется из publish_jobs при первом обращении; прошедшие
+    времена отбрасываются.
+    """
+
+    def __init__(self, group_spacing: float = PUBLISH_GROUP_SPACING, token_spacing: float = PUBLISH_TOKEN_SPACING):
+        self.group_spacing = group_spacing
+        self.token_spacing = token_spacing
+        self._groups: dict[int, list[float]] = {}
+        self._tokens: dict[int, list[float]] = {}
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    async def load(self) -> None:
+        async with self._lock:
+            if self._loaded:
+                return
+            for group_id, tg_id, due_at in await run_db(get_scheduled_publish_slots, time.time()):
+                self._add(group_id, tg_id, due_at)
+            self._loaded = True
+
+    def _add(self, group_id: int, tg_id: int, slot: float) -> None:
+        insort(self._groups.setdefault(group_id, []), slot)
+        insort(self._tokens.setdefault(tg_id, []), slot)
+
+    @staticmethod
+    def _conflict(slots: list[float], candidate: float, spacing: float):
+        """
+        Возвращает ближайшее занятое время, мешающее candidate, или None.
+        """
+        index = bisect_left(slots, candidate - spacing + EPSILON)
+        if index < len(slots) and slots[index] < candidate + spacing - EPSILON:
+            return slots[index]
+        return None
+
+    def _prune(self, calendar: dict[int, list[float]], key: int, before: float) -> list[float]:
+        slots = calendar.get(key, [])
+        index = bisect_left(slots, before)
+        if index:
+            del slots[:index]
+        return slots
+
+    def next_slot(self, group_id: int, tg_id: int, start: float) -> float:
+        """
+        Ближайшее время не раньше start, свободное и в группе, и у токена.
+        """
+        horizon = time.time() - max(self.group_spacing, self.token_spacing)
+        group_slots = self._prune(self._groups, group_id, horizon)
+        token_slots = self._prune(self._tokens, tg_id, horizon)
+        candidate = start
+        while True:
+            busy = self._conflict(group_slots, candidate, self.group_spacing)
+            if busy is not None:
+                candidate = busy + self.group_spacing
+                continue
+            busy = self._conflict(token_slots, candidate, self.token_spacing)
+            if busy is not None:
+                candidate = busy + self.token_spacing
+                continue
+            return candidate
+
+    async def reserve(self, group_id: int, tg_id: int, start: float, count: int) -> list[float]:
+        """
+        Занимает count последовательных свободных слотов начиная со start (но не раньше текущего момента)
+        и возвращает их.
+        """
+        await self.load()
+        slots = []
+        candidate = max(start, time.time())
+        for _ in range(count):
+            candidate = self.next_slot(group_id, tg_id, candidate)
+            self._add(group_id, tg_id, candidate)
+            slots.append(candidate)
+        return slots
+
+    def release(self, group_id: int, tg_id: int, slots: Iterable[float]) -> None:
+        """
+        Освобождает слоты, которые не удалось поставить в очередь.
+        """
+        for slot in slots:
+            for calendar, key in ((self._groups, group_id), (self._tokens, tg_id)):
+                entries = calendar.get(key, [])
+                index = bisect_left(entries, slot)
+                if index < len(entries) and entries[index] == slot:
+                    del entries[index]
+
+
+publish_calendar = PublishCalendar()
@@ -0,0 +1,231 @@
+import time
+import asyncio
+import pytz
+
+from datetime import datetime
+from typing import Optional
+
+from env import (
+    TIMEZONE,
+    PUBLISH_CONCURRENCY,
+    PUBLISH_POLL_INTERVAL,
+    PUBLISH_MAX_ATTEMPTS,
+    PREUPLOAD_CONCURRENCY,
+    WORKER_ID,
+    JOB_LEASE_TIMEOUT,
+)
+from database import *
+from media_cache import media_cache
+from vk_api_requests import upload_video, publish_video_post
+from batch_upload import batch_uploader, retry_delay
+from publish_calendar import publish_calendar
+from metrics import registry, PUBLISH_LATENESS_SECONDS, RETRIES_TOTAL, FAILURES_TOTAL, QUEUE_DEPTH
+from retry import CircuitOpenError
+
+
+def to_timestamp(publish_time: datetime) -> float:
+    """
+    Переводит время публикации в unix time. Время без часового пояса считается локальным для TIMEZONE.
+    """
+    if publish_time.tzinfo is None:
+        publish_time = pytz.timezone(TIMEZONE).localize(publish_time)
+    return publish_time.timestamp()
+
+
+class PublishDispatcher:
+    """
+    Выполняет задачи из таблицы publish_jobs в основном event loop в две фазы.
+    Сразу после постановки в очередь видео загружается в VK (video.save и файл),
+    а в назначенное время выполняется только wall.post с сохраненным video_id.
+    Задачи выбираются по индексу (state, due_at); неудачные попытки
+    повторяются с растущей задержкой до PUBLISH_MAX_ATTEMPTS раз.
+    Задачи берутся в аренду на JOB_LEASE_TIMEOUT секунд от имени owner, и аренда
+    продлевается, пока процесс жив, поэтому несколько процессов могут разбирать одну
+    очередь: каждую задачу выполняет один из них, а задачи упавшего процесса
+    забираются другими после истечения аренды. owner должен быть уникален для
+    каждого живого процесса и постоянен между перезапусками: при запуске диспетчер
+    сразу возвращает в очередь задачи, арендованные на его owner, и задачи с истекшей арендой.
+    """
+
+    def __init__(self, concurrency: int = PUBLISH_CONCURRENCY,
+                 upload_concurrency: int = PREUPLOAD_CONCURRENCY,
+                 poll_interval: float = PUBLISH_POLL_INTERVAL,
+                 owner: str = f'{WORKER_ID}:bot',
+                 lease_timeout: float = JOB_LEASE_TIMEOUT):
+        self.owner = owner
+        self.lease_timeout = lease_timeout
+        self.concurrency = concurrency
+        self.upload_concurrency = upload_concurrency
+        self.poll_interval = poll_interval
+        self._tasks: list[asyncio.Task] = []
+        self._publish_wakeup: Optional[asyncio.Event] = None
+        self._upload_wakeup: Optional[asyncio.Event] = None
+        self._publishing: set[asyncio.Task] = set()
+        self._uploading: set[asyncio.Task] = set()
+
+    def lease_until(self) -> float:
+        return time.time() + self.lease_timeout
+
+    async def start(self, process_jobs: bool = True) -> None:
+        """
+        Запускает продление аренды и, если process_jobs, разбор очереди.
+        Без process_jobs процесс только ставит задачи, а выполняют их воркеры.
+        """
+        for file_path in await run_db(recover_publish_jobs, self.owner, time.time()):
+            media_cache.pin(file_path)
+        self._publish_wakeup = asyncio.Event()
+        self._upload_wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._renew_leases())]
+        if not process_jobs:
+            return
+        self._tasks += [
+            asyncio.create_task(self._loop(
+                claim_due_publish_jobs, get_next_publish_due_at, self._execute,
+                self.concurrency, self._publishing, self._publish_wakeup
+            )),
+            asyncio.create_task(self._loop(
+                claim_upload_jobs, get_next_upload_attempt_at, self._preupload,
+                self.upload_concurrency, self._uploading, self._upload_wakeup
+            )),
+        ]
+
+    def notify(self) -> None:
+        for wakeup in (self._publish_wakeup, self._upload_wakeup):
+            if wakeup is not None:
+                wakeup.set()
+
+    async def stop(self) -> None:
+        tasks = [*self._tasks, *self._publishing, *self._uploading]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _renew_leases(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease_timeout / 3)
+            try:
+                await run_db(renew_publish_job_leases, self.owner, self.lease_until())
+            except Exception as e:
+                print(f"Не удалось продлить аренду задач {self.owner}: {e!r}")
+
+    async def _loop(self, claim, next_attempt_at, execute, limit: int, running: set, wakeup: asyncio.Event) -> None:
+        while True:
+            wakeup.clear()
+            timeout = self.poll_interval
+            free_slots = limit - len(running)
+            if free_slots > 0:
+                jobs = await run_db(claim, time.time(), free_slots, self.owner, self.lease_until())
+                for job in jobs:
+                    task = asyncio.create_task(execute(job))
+                    running.add(task)
+                    task.add_done_callback(lambda task: (running.discard(task), wakeup.set()))
+                if len(jobs) == free_slots:
+                    continue
+
+                next_at = await run_db(next_attempt_at)
+                if next_at is not None:
+                    timeout = min(timeout, max(next_at - time.time(), 0))
+
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _preupload(self, job) -> None:
+        if await batch_uploader.upload_job(job):
+            self.notify()
+
+    async def _execute(self, job) -> None:
+        video_id = job['video_id']
+        pinned = video_id is None
+        try:
+            if video_id is None:
+                video_id = await upload_video(job['group_id'], job['description'], job['file_path'], job['tg_id'], job['id'])
+                await run_db(set_publish_job_video, job['id'], video_id)
+                media_cache.unpin(job['file_path'])
+                pinned = False
+            # Видео загружено с описанием первой группы, остальные группы получают свое описание текстом поста
+            message = job['description'] if job['upload_job_id'] is not None else None
+            await publish_video_post(job['group_id'], video_id, job['tg_id'], owner_id=job['video_owner_id'], message=message)
+        except CircuitOpenError as e:
+            print(f"Задача публикации {job['id']} отложена: {e}")
+            await run_db(postpone_publish_job, job['id'], repr(e), e.retry_at)
+            return
+        except Exception as e:
+            attempts = job['attempts'] + 1
+            if attempts < PUBLISH_MAX_ATTEMPTS:
+                retry_at = time.time() + retry_delay(attempts)
+                RETRIES_TOTAL.inc(operation='publish')
+                print(f"Ошибка публикации задачи {job['id']} (попытка {attempts}): {e!r}. Повтор через {retry_at - time.time():.0f} c")
+                await run_db(fail_publish_job, job['id'], repr(e), retry_at)
+            else:
+                FAILURES_TOTAL.inc(operation='publish')
+                print(f"Задача публикации {job['id']} не выполнена после {attempts} попыток, задача в dead: {e!r}")
+                await run_db(fail_publish_job, job['id'], repr(e))
+                if pinned:
+                    media_cache.unpin(job['file_path'])
+            return
+
+        lateness = time.time() - job['due_at']
+        PUBLISH_LATENESS_SECONDS.observe(lateness)
+        await run_db(finish_publish_job, job['id'])
+        print(f"Задача публикации {job['id']} выполнена, опоздание {lateness:.2f} c")
+
+
+publish_dispatcher = PublishDispatcher()
+
+
+async def _collect_queue_metrics() -> None:
+    counts = dict(await run_db(count_publish_jobs_by_state))
+    for state in ('new', 'uploading', 'waiting', 'pending', 'running', 'dead'):
+        QUEUE_DEPTH.set(counts.get(state, 0), queue='publish', state=state)
+
+
+registry.add_collector(_collect_queue_metrics)
+
+
+async def requeue_dead_jobs() -> int:
+    """
+    Возвращает задачи из dead в очередь, закрепляет их файлы и возвращает число задач.
+    """
+    count, file_paths = await run_db(requeue_dead_publish_jobs)
+    for file_path in file_paths:
+        media_cache.pin(file_path)
+    publish_dispatcher.notify()
+    return count
+
+
+async def schedule_batch_publish(group_ids: list[int], tg_id: int, publish_time: datetime,
+                                 temp_file_paths: list[str]) -> list:
+    """
+    Ставит пачку видео в очередь публикации во все группы group_ids одной транзакцией.
+    Время каждого видео в каждой группе - ближайший свободный слот календаря начиная
+    с publish_time. Каждое видео загружается в VK один раз задачей первой группы:
+    эти задачи возвращаются и сразу помечаются uploading, чтобы их загрузил вызывающий
+    через batch_uploader. Задачи остальных групп публикуют то же видео, когда оно загружено.
+    """
+    start = to_timestamp(publish_time)
+    slots = {}
+    try:
+        for group_id in group_ids:
+            slots[group_id] = await publish_calendar.reserve(group_id, tg_id, start, len(temp_file_paths))
+        upload_group_id, crosspost_group_ids = group_ids[0], group_ids[1:]
+        jobs = await run_db(
+            add_publish_jobs,
+            [
+                (upload_group_id, tg_id, get_group_description(upload_group_id), path, slot)
+                for path, slot in zip(temp_file_paths, slots[upload_group_id])
+            ],
+            'uploading', publish_dispatcher.owner, publish_dispatcher.lease_until(),
+            [
+                [(group_id, get_group_description(group_id), slots[group_id][index]) for group_id in crosspost_group_ids]
+                for index in range(len(temp_file_paths))
+            ]
+        )
+    except Exception:
+        for group_id, group_slots in slots.items():
+            publish_calendar.release(group_id, tg_id, group_slots)
+        raise
+    publish_dispatcher.notify()
+    return jobs
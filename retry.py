@@ -0,0 +1,162 @@
+import time
+import random
+import asyncio
+import aiohttp
+
+from typing import Awaitable, Callable, Final, TypeVar
+
+from env import CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT
+from vk_client import VKAPIError, VKIDError, VKHTTPError
+from vk_upload import UploadError
+from metrics import registry, RETRIES_TOTAL, FAILURES_TOTAL, CIRCUIT_OPEN
+
+T = TypeVar('T')
+
+# Коды ошибок VK, после которых запрос имеет смысл повторить:
+# неизвестная ошибка, слишком много запросов, flood control, внутренняя ошибка сервера
+TRANSIENT_VK_ERRORS: Final = {1, 6, 9, 10}
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, endpoint: str, retry_at: float):
+        self.endpoint = endpoint
+        self.retry_at = retry_at
+        super().__init__(f"{endpoint} временно недоступен, следующая попытка через {retry_at - time.time():.0f} c")
+
+
+def is_transient(error: Exception) -> bool:
+    if isinstance(error, VKAPIError):
+        return error.code in TRANSIENT_VK_ERRORS
+    if isinstance(error, VKIDError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (VKHTTPError, aiohttp.ClientError, asyncio.TimeoutError, UploadError))
+
+
+class RetryPolicy:
+    """
+    Сколько раз и с какой задержкой повторять вызов. Задержка растет экспоненциально
+    от base_delay до max_delay и выбирается случайно от нуля до этой границы (full jitter),
+    чтобы повторы от многих задач не приходили в VK одновременно.
+    """
+
+    def __init__(self, attempts: int, base_delay: float, max_delay: float):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """
+    Размыкается после failure_threshold неудач подряд и reset_timeout секунд
+    отклоняет вызовы без обращения к VK. Затем пропускает один пробный вызов:
+    успех замыкает цепь, неудача снова размыкает ее.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def retry_at(self) -> float:
+        return (self.opened_at or 0) + self.reset_timeout
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self._probing or time.time() < self.retry_at:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            print(f"Цепь {self.name} снова замкнута")
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def release_probe(self) -> None:
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self._probing or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                print(f"Цепь {self.name} разомкнута после {self.failures} неудач подряд")
+            self.opened_at = time.time()
+        self._probing = False
+
+
+POLICIES: Final = {
+    'video.save': RetryPolicy(attempts=4, base_delay=1, max_delay=30),
+    'upload': RetryPolicy(attempts=3, base_delay=2, max_delay=60),
+    'wall.post': RetryPolicy(attempts=4, base_delay=1, max_delay=30),
+    'oauth': RetryPolicy(attempts=2, base_delay=5, max_delay=60),
+}
+DEFAULT_POLICY: Final = RetryPolicy(attempts=3, base_delay=0.5, max_delay=10)
+
+breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(endpoint: str) -> CircuitBreaker:
+    breaker = breakers.get(endpoint)
+    if breaker is None:
+        breaker = breakers[endpoint] = CircuitBreaker(endpoint)
+    return breaker
+
+
+async def call_with_retry(endpoint: str, func: Callable[..., Awaitable[T]], *args, **kwargs) -> T:
+    """
+    Вызывает func с политикой повторов endpoint через его предохранитель.
+    Повторяются только временные ошибки (сеть, таймауты, ошибки VK 1, 6, 9, 10);
+    остальные пробрасываются сразу и цепь не размыкают.
+    Если цепь разомкнута, выбрасывает CircuitOpenError.
+    """
+    policy = POLICIES.get(endpoint, DEFAULT_POLICY)
+    breaker = get_breaker(endpoint)
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            raise CircuitOpenError(endpoint, breaker.retry_at)
+        attempt += 1
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            breaker.release_probe()
+            raise
+        except Exception as e:
+            if not is_transient(e):
+                # VK ответил осмысленной ошибкой, значит сам сервис доступен
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if attempt >= policy.attempts:
+                FAILURES_TOTAL.inc(operation=endpoint)
+                raise
+            delay = policy.delay(attempt)
+            RETRIES_TOTAL.inc(operation=endpoint)
+            print(f"{endpoint}: временная ошибка {e!r}, попытка {attempt}/{policy.attempts}, повтор через {delay:.1f} c")
+            await asyncio.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+
+
+async def _collect_breaker_metrics() -> None:
+    for name, breaker in breakers.items():
+        CIRCUIT_OPEN.set(1 if breaker.is_open else 0, endpoint=name)
+
+
+registry.add_collector(_collect_breaker_metrics)
@@ -0,0 +1,104 @@
+import os
+import asyncio
+import hashlib
+import aiohttp
+
+from typing import Optional
+from aiogram import Bot
+
+from env import TG_DOWNLOAD_CHUNK_SIZE
+from vk_client import create_session
+
+
+class DownloadError(Exception):
+    pass
+
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = create_session(total_timeout=None)
+    return _session
+
+
+async def close_download_session() -> None:
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def _hash_file(path: str, hasher) -> int:
+    size = 0
+    with open(path, 'rb') as file:
+        while chunk := file.read(TG_DOWNLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+            size += len(chunk)
+    return size
+
+
+def _write_chunk(file, chunk: bytes) -> None:
+    file.write(chunk)
+
+
+def _copy_local(source: str, part_path: str, offset: int, hasher) -> None:
+    with open(source, 'rb') as src, open(part_path, 'ab' if offset else 'wb') as dst:
+        src.seek(offset)
+        while chunk := src.read(TG_DOWNLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+            dst.write(chunk)
+
+
+async def download_telegram_file(bot: Bot, file_id: str, destination: str) -> str:
+    """
+    Скачивает файл из Telegram потоково прямо в destination.
+    Данные пишутся в destination.part, при повторном вызове докачка идет
+    с места обрыва через заголовок Range. По завершении файл атомарно
+    переименовывается. Возвращает sha256 содержимого.
+    """
+    os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+    part_path = f"{destination}.part"
+
+    tg_file = await bot.get_file(file_id)
+    if tg_file.file_path is None:
+        raise DownloadError(f"Telegram не вернул file_path для {file_id}")
+
+    hasher = hashlib.sha256()
+    offset = 0
+    if os.path.exists(part_path):
+        offset = await asyncio.to_thread(_hash_file, part_path, hasher)
+
+    api = bot.session.api
+    if api.is_local:
+        source = str(api.wrap_local_file.to_local(tg_file.file_path))
+        await asyncio.to_thread(_copy_local, source, part_path, offset, hasher)
+    else:
+        url = api.file_url(bot.token, tg_file.file_path)
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        session = _get_session()
+        async with session.get(url, headers=headers) as response:
+            if response.status == 200 and offset:
+                hasher = hashlib.sha256()
+                offset = 0
+            elif response.status == 416 and offset and offset == tg_file.file_size:
+                pass
+            elif response.status not in (200, 206):
+                raise DownloadError(f"{response.status} - {await response.text()}")
+
+            if response.status != 416:
+                with open(part_path, 'ab' if offset else 'wb') as part_file:
+                    async for chunk in response.content.iter_chunked(TG_DOWNLOAD_CHUNK_SIZE):
+                        hasher.update(chunk)
+                        await asyncio.to_thread(_write_chunk, part_file, chunk)
+
+    size = os.path.getsize(part_path)
+    if tg_file.file_size is not None and size != tg_file.file_size:
+        if size > tg_file.file_size:
+            os.remove(part_path)
+        raise DownloadError(f"Размер файла {size} не совпадает с ожидаемым {tg_file.file_size}")
+
+    os.replace(part_path, destination)
+    return hasher.hexdigest()
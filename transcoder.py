@@ -0,0 +1,415 @@
+import os
+import re
+import csv
+import glob
+import json
+import time
+import asyncio
+import subprocess
+import multiprocessing
+import moviepy as mp
+
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from moviepy.config import FFMPEG_BINARY
+
+from env import TRANSCODE_WORKERS, TRANSCODE_QUEUE_SIZE, FFPROBE_BINARY, PROBE_CACHE_SIZE, SPLIT_MIN_TAIL_SECONDS
+from metrics import registry, TRANSCODE_SECONDS, FAILURES_TOTAL, QUEUE_DEPTH
+
+MAX_CLIP_DURATION = 59
+VK_VIDEO_CODECS = {'h264'}
+VK_AUDIO_CODECS = {'aac'}
+VK_CONTAINERS = {'mp4', 'mov'}
+
+
+class TranscodeQueueFull(Exception):
+    pass
+
+
+class TranscodeError(Exception):
+    pass
+
+
+_probe_cache: OrderedDict = OrderedDict()
+_ffprobe_missing = False
+
+
+async def _run(*command: str) -> bytes:
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise TranscodeError(stderr.decode(errors='replace').strip())
+    return stdout
+
+
+async def ffmpeg_probe(path: str) -> Optional[dict]:
+    """
+    Разбирает заголовок, который печатает ffmpeg -i, в словарь того же вида, что и у ffprobe
+    (format.format_name, streams[].codec_type и codec_name). Возвращает None, если ffmpeg не смог открыть файл.
+    """
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_BINARY, '-hide_banner', '-i', path,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    # Без выходного файла ffmpeg всегда завершается с ошибкой, поэтому код возврата не проверяется
+    _, stderr = await process.communicate()
+    output = stderr.decode(errors='replace')
+    match = re.search(r'^Input #0, (.+?), from ', output, re.MULTILINE)
+    if match is None:
+        return None
+    streams = [
+        {'codec_type': codec_type.lower(), 'codec_name': codec_name}
+        for codec_type, codec_name in re.findall(r'^\s*Stream #0:\d+\S*: (Video|Audio|Subtitle|Data): (\w+)', output, re.MULTILINE)
+    ]
+    return {'format': {'format_name': match.group(1)}, 'streams': streams}
+
+
+async def probe_media(path: str) -> Optional[dict]:
+    """
+    Возвращает описание контейнера и потоков файла от ffprobe.
+    Если ffprobe не установлен, описание берется из заголовка ffmpeg -i (ffmpeg_probe).
+    Результат кэшируется по пути, размеру и времени изменения файла.
+    Если файл не читается, возвращает None.
+    """
+    global _ffprobe_missing
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key in _probe_cache:
+        _probe_cache.move_to_end(key)
+        return _probe_cache[key]
+
+    info = None
+    if not _ffprobe_missing:
+        try:
+            output = await _run(
+                FFPROBE_BINARY, '-v', 'error', '-print_format', 'json',
+                '-show_format', '-show_streams', path
+            )
+            info = json.loads(output)
+        except FileNotFoundError:
+            _ffprobe_missing = True
+            print(f"ВНИМАНИЕ: {FFPROBE_BINARY} не найден, информация о файлах берется из заголовка ffmpeg. "
+                  f"Установите ffprobe или укажите путь к нему в FFPROBE_BINARY.")
+        except (TranscodeError, ValueError) as e:
+            print(f"Не удалось получить информацию о файле {path}: {e}")
+    if _ffprobe_missing:
+        info = await ffmpeg_probe(path)
+        if info is None:
+            print(f"Не удалось получить информацию о файле {path} от ffmpeg")
+
+    _probe_cache[key] = info
+    if len(_probe_cache) > PROBE_CACHE_SIZE:
+        _probe_cache.popitem(last=False)
+    return info
+
+
+def can_stream_copy(info: Optional[dict]) -> bool:
+    """
+    Файл можно обрезать без перекодирования, если контейнер и кодеки уже подходят VK (MP4, H.264/AAC).
+    """
+    if not info:
+        return False
+
+    containers = set(info.get('format', {}).get('format_name', '').split(','))
+    if not containers & VK_CONTAINERS:
+        return False
+
+    streams = info.get('streams', [])
+    video_codecs = {s.get('codec_name') for s in streams if s.get('codec_type') == 'video'}
+    audio_codecs = {s.get('codec_name') for s in streams if s.get('codec_type') == 'audio'}
+    return (
+        len(video_codecs) == 1 and video_codecs <= VK_VIDEO_CODECS
+        and audio_codecs <= VK_AUDIO_CODECS
+    )
+
+
+async def stream_copy_trim(source: str, destination: str, duration: float = MAX_CLIP_DURATION) -> None:
+    """
+    Обрезает видео без перекодирования. Начало совпадает с первым ключевым кадром,
+    конец приходится на последний пакет до duration.
+    """
+    await _run(
+        FFMPEG_BINARY, '-v', 'error', '-y', '-i', source,
+        '-t', str(duration), '-map', '0:v:0', '-map', '0:a?',
+        '-c', 'copy', '-avoid_negative_ts', 'make_zero',
+        '-movflags', '+faststart', destination
+    )
+
+
+def trim_video(source: str, destination: str, duration: float = MAX_CLIP_DURATION) -> None:
+    """
+    Обрезает видео до duration секунд с перекодированием. Выполняется в процессе пула.
+    """
+    video_clip = mp.VideoFileClip(source)
+    trimmed_clip = video_clip.subclipped(0, duration)
+    try:
+        trimmed_clip.write_videofile(
+            destination,
+            codec="libx264",
+            audio_codec="aac",
+            fps=video_clip.fps,
+            bitrate="3000k",
+            ffmpeg_params=["-preset", "ultrafast"],
+            logger=None
+        )
+    finally:
+        trimmed_clip.close()
+        video_clip.close()
+
+
+def _segment_args(destination_template: str, list_path: str, cut_args: list[str]) -> list[str]:
+    return [
+        '-f', 'segment', *cut_args, '-reset_timestamps', '1',
+        '-segment_format', 'mp4', '-segment_format_options', 'movflags=+faststart',
+        '-segment_list', list_path, '-segment_list_type', 'csv',
+        destination_template,
+    ]
+
+
+def read_segment_list(list_path: str) -> list[tuple[float, float]]:
+    """
+    Читает список сегментов ffmpeg (filename,start,end) и возвращает границы каждого сегмента.
+    """
+    with open(list_path, newline='') as list_file:
+        return [(float(row[1]), float(row[2])) for row in csv.reader(list_file) if row]
+
+
+async def keyframe_times(source: str) -> tuple[list[float], Optional[float]]:
+    """
+    Возвращает времена ключевых кадров первой видеодорожки и длительность файла (None, если ffmpeg ее не сообщил).
+    Декодируются только ключевые кадры.
+    """
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_BINARY, '-hide_banner', '-skip_frame', 'nokey', '-i', source,
+        '-map', '0:v:0', '-vf', 'showinfo', '-f', 'null', '-',
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise TranscodeError(stderr.decode(errors='replace').strip())
+    output = stderr.decode(errors='replace')
+    keyframes = sorted(float(value) for value in re.findall(r'pts_time:\s*(-?[\d.]+)', output))
+    match = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', output)
+    total = int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3)) if match else None
+    return keyframes, total
+
+
+def keyframe_cuts(keyframes: list[float], total: Optional[float], duration: float) -> Optional[list[float]]:
+    """
+    Выбирает точки разреза: каждый раз последний ключевой кадр не дальше duration от начала сегмента.
+    Возвращает None, если длительность неизвестна или между ключевыми кадрами больше duration секунд.
+    """
+    if total is None:
+        return None
+    cuts = []
+    start = 0.0
+    while total - start > duration:
+        limit = bisect_right(keyframes, start + duration) - 1
+        if limit < 0 or keyframes[limit] <= start:
+            return None
+        start = keyframes[limit]
+        cuts.append(start)
+    return cuts
+
+
+async def stream_copy_split(source: str, destination_template: str, list_path: str,
+                            duration: float = MAX_CLIP_DURATION) -> Optional[list[tuple[float, float]]]:
+    """
+    Режет видео без перекодирования за один проход. Разрезы ставятся на последний
+    ключевой кадр до каждой границы в duration секунд. Возвращает None, если ключевые кадры
+    слишком редкие и без перекодирования уложиться в duration нельзя.
+    """
+    cuts = keyframe_cuts(*await keyframe_times(source), duration)
+    if cuts is None:
+        return None
+    # Сегмент начинается с первого ключевого кадра не раньше заданного времени,
+    # поэтому время берется чуть раньше кадра, чтобы округление не сдвинуло разрез на следующий
+    if cuts:
+        cut_args = ['-segment_times', ','.join(f'{cut - 0.001:.3f}' for cut in cuts)]
+    else:
+        cut_args = ['-segment_time', str(duration)]
+    await _run(
+        FFMPEG_BINARY, '-v', 'error', '-y', '-i', source,
+        '-map', '0:v:0', '-map', '0:a?', '-c', 'copy',
+        *_segment_args(destination_template, list_path, cut_args)
+    )
+    return read_segment_list(list_path)
+
+
+def split_video(source: str, destination_template: str, list_path: str,
+                duration: float = MAX_CLIP_DURATION) -> list[tuple[float, float]]:
+    """
+    Режет видео на сегменты по duration секунд с перекодированием за одно декодирование.
+    Ключевые кадры ставятся точно на границах сегментов. Выполняется в процессе пула.
+    """
+    result = subprocess.run([
+        FFMPEG_BINARY, '-v', 'error', '-y', '-i', source,
+        '-map', '0:v:0', '-map', '0:a?',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-b:v', '3000k', '-c:a', 'aac',
+        '-force_key_frames', f'expr:gte(t,n_forced*{duration})',
+        *_segment_args(destination_template, list_path, ['-segment_time', str(duration)])
+    ], capture_output=True)
+    if result.returncode != 0:
+        raise TranscodeError(result.stderr.decode(errors='replace').strip())
+    return read_segment_list(list_path)
+
+
+class Transcoder:
+    """
+    Пул процессов для перекодирования видео вне event loop.
+    Одновременно выполняется не больше workers задач, еще queue_size ждут
+    в очереди; при переполнении submit выбрасывает TranscodeQueueFull.
+    """
+
+    def __init__(self, workers: int = TRANSCODE_WORKERS, queue_size: int = TRANSCODE_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._queued = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queued
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            self._slots = asyncio.Semaphore(self.workers)
+        return self._executor
+
+    async def submit(self, func, *args):
+        """
+        Ставит задачу в очередь пула и ждет ее результат.
+        """
+        if self._queued >= self.queue_size:
+            raise TranscodeQueueFull(f"В очереди уже {self._queued} задач")
+
+        executor = self._get_executor()
+        self._queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._queued -= 1
+
+        started = time.monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+        finally:
+            elapsed = time.monotonic() - started
+            self._slots.release()
+            print(f"Задача {func.__name__}{args} выполнена за {elapsed:.1f} c, в очереди: {self._queued}")
+
+    async def trim(self, path: str, destination: Optional[str] = None, duration: float = MAX_CLIP_DURATION) -> None:
+        """
+        Обрезает path и сохраняет результат в destination (по умолчанию - поверх исходного файла).
+        Результат пишется во временный файл и атомарно переименовывается.
+        Если исходник уже в H.264/AAC, обрезка идет копированием потоков,
+        иначе видео перекодируется в пуле процессов.
+        """
+        destination = destination or path
+        root, ext = os.path.splitext(destination)
+        trimmed_path = f"{root}.trimming{ext}"
+        try:
+            if can_stream_copy(await probe_media(path)):
+                try:
+                    with TRANSCODE_SECONDS.time(method='copy'):
+                        await stream_copy_trim(path, trimmed_path, duration)
+                    os.replace(trimmed_path, destination)
+                    return
+                except TranscodeError as e:
+                    FAILURES_TOTAL.inc(operation='stream_copy')
+                    print(f"Не удалось обрезать {path} без перекодирования: {e}")
+
+            with TRANSCODE_SECONDS.time(method='reencode'):
+                await self.submit(trim_video, path, trimmed_path, duration)
+            os.replace(trimmed_path, destination)
+        finally:
+            if os.path.exists(trimmed_path):
+                os.remove(trimmed_path)
+
+    async def split(self, path: str, destination_template: str, duration: float = MAX_CLIP_DURATION,
+                    min_tail: float = SPLIT_MIN_TAIL_SECONDS) -> list[str]:
+        """
+        Режет path на последовательные сегменты не длиннее duration секунд за один проход.
+        destination_template содержит %03d - номер сегмента. Если исходник в H.264/AAC и
+        ключевые кадры позволяют уложиться в duration, потоки копируются, иначе видео
+        перекодируется в пуле процессов. Последний сегмент короче min_tail секунд отбрасывается,
+        как при обрезке, чтобы видео чуть длиннее минуты не давало отдельный клип из пары секунд.
+        Возвращает пути сегментов по порядку.
+        """
+        root, ext = os.path.splitext(destination_template)
+        temp_template = f"{root}.splitting{ext}"
+        list_path = f"{root.replace('%03d', '')}.segments.csv"
+        try:
+            segments = None
+            if can_stream_copy(await probe_media(path)):
+                segments = await self._split_copy(path, temp_template, list_path, duration)
+                if segments is None:
+                    self._remove_matching(temp_template)
+
+            if segments is None:
+                with TRANSCODE_SECONDS.time(method='split_reencode'):
+                    segments = await self.submit(split_video, path, temp_template, list_path, duration)
+
+            if len(segments) > 1 and segments[-1][1] - segments[-1][0] < min_tail:
+                start, end = segments.pop()
+                print(f"Последний сегмент {path} длиной {end - start:.1f} c отброшен")
+
+            paths = []
+            for index in range(len(segments)):
+                os.replace(temp_template % index, destination_template % index)
+                paths.append(destination_template % index)
+            return paths
+        finally:
+            self._remove_matching(temp_template)
+            if os.path.exists(list_path):
+                os.remove(list_path)
+
+    @staticmethod
+    async def _split_copy(path: str, temp_template: str, list_path: str, duration: float) -> Optional[list[tuple[float, float]]]:
+        """
+        Разрезает без перекодирования. Возвращает None, если это не удалось или какой-то сегмент длиннее duration.
+        """
+        try:
+            with TRANSCODE_SECONDS.time(method='split_copy'):
+                segments = await stream_copy_split(path, temp_template, list_path, duration)
+        except TranscodeError as e:
+            FAILURES_TOTAL.inc(operation='stream_copy')
+            print(f"Не удалось разрезать {path} без перекодирования: {e}")
+            return None
+        if segments is None or any(end - start > duration for start, end in segments):
+            print(f"Ключевые кадры в {path} не позволяют разрезать его без перекодирования")
+            return None
+        return segments
+
+    @staticmethod
+    def _remove_matching(template: str) -> None:
+        for leftover in glob.glob(glob.escape(template).replace('%03d', '*')):
+            os.remove(leftover)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+transcoder = Transcoder()
+
+
+async def _collect_transcode_metrics() -> None:
+    QUEUE_DEPTH.set(transcoder.queue_depth, queue='transcode')
+
+
+registry.add_collector(_collect_transcode_metrics)
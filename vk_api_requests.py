@@ -1,33 +1,34 @@
 
 import re
-import requests
 import asyncio
-import urllib
 import string
 import random
 import os
+import time
 
-from typing import Final
-from datetime import datetime
+from typing import Optional
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from env import CLIENT_SECRET, CLIENT_ID
+from env import CLIENT_ID, TOKEN_REFRESH_MARGIN, TOKEN_REFRESH_CONCURRENCY, TOKEN_REFRESH_MAX_BACKOFF
 from database import *
-VERSION: Final = '5.199'
+from vk_client import vk_client, VKAPIError, VKIDError, VK_ID_URL, VERSION
+from vk_upload import upload_video_file
+from metrics import VK_VIDEO_SAVE_SECONDS, VK_UPLOAD_SECONDS, VK_WALL_POST_SECONDS, FAILURES_TOTAL
+from retry import call_with_retry, get_breaker, CircuitOpenError
 
 scheduler = AsyncIOScheduler()
 
 
-def get_access_token_with_refresh_token(refresh_token, device_id):
+async def get_access_token_with_refresh_token(refresh_token, device_id):
     """
     Получает новый access_token с использованием refresh_token.
 
     :param client_id: ID вашего приложения VK.
     :param client_secret: Секретный ключ вашего приложения VK.
     :param refresh_token: Refresh token, полученный ранее.
-    :return: Новый access_token.
+    :return: Новый access_token, refresh_token и момент истечения access_token (unix time).
     """
-    url = 'https://id.vk.com/oauth2/auth'
+    url = f'{VK_ID_URL}/oauth2/auth'
     le_state = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
     params = {
         'grant_type': 'refresh_token',
@@ -37,133 +38,182 @@ def get_access_token_with_refresh_token(refresh_token, device_id):
         'state': le_state
     }
 
-    response = requests.post(url, data=params)
+    status, data = await call_with_retry('oauth', vk_client.post_form, url, params)
 
-    if response.status_code == 200:
-        data = response.json()
-        return data.get('access_token'), data.get('refresh_token')
+    if status == 200:
+        return data.get('access_token'), data.get('refresh_token'), token_expires_at(data)
     else:
-        raise Exception(f"Ошибка при получении access_token: {response.status_code} - {response.text}")
+        raise VKIDError(status, data)
 
-def update_access_tokens():
+def token_expires_at(tokens: dict):
+    expires_in = tokens.get('expires_in')
+    if expires_in is None:
+        return None
+    return int(time.time()) + int(expires_in)
+
+_refresh_failures = {}
+
+async def refresh_user_token(tg_id, refresh_token, device_id):
+    failures, retry_at = _refresh_failures.get(tg_id, (0, 0))
+    if time.time() < retry_at:
+        return
+
+    try:
+        new_access_token, new_refresh_token, expires_at = await get_access_token_with_refresh_token(refresh_token, device_id)
+        if new_access_token != None and new_refresh_token != None:
+            await run_db(update_token, tg_id, new_access_token, new_refresh_token, expires_at)
+            _refresh_failures.pop(tg_id, None)
+            print(f"Обновлен access_token для пользователя с tg_id: {tg_id}")
+            return
+        print(f"Ошибка при обновлении токена у пользователяс tg_id: {tg_id}")
+    except CircuitOpenError:
+        return
+    except Exception as e:
+        print(f"Ошибка при обновлении access_token для пользователя с tg_id: {tg_id} - {e}")
+
+    FAILURES_TOTAL.inc(operation='token_refresh')
+    failures += 1
+    backoff = min(60 * 2 ** (failures - 1), TOKEN_REFRESH_MAX_BACKOFF)
+    _refresh_failures[tg_id] = (failures, time.time() + backoff)
+
+async def update_access_tokens():
     """
-    Обновляет access_token для всех пользователей в базе данных.
+    Обновляет access_token у пользователей, чей токен скоро истечет.
+    Запросы идут параллельно, но не больше TOKEN_REFRESH_CONCURRENCY одновременно;
+    после неудачи следующая попытка для пользователя откладывается с экспоненциальной задержкой.
+    Пока предохранитель VK ID разомкнут, обновление пропускается целиком.
     """
-    users = get_users()
-
-    for user in users:
-        tg_id, refresh_token, device_id = user
-        try:
-            new_access_token, new_refresh_token = get_access_token_with_refresh_token(refresh_token, device_id)
-            if new_access_token != None and new_refresh_token != None:
-                update_token(tg_id, new_access_token, new_refresh_token)
-                print(f"Обновлен access_token для пользователя с tg_id: {tg_id}")
-            else:
-                print(f"Ошибка при обновлении токена у пользователяс tg_id: {tg_id}")
-        except Exception as e:
-            print(f"Ошибка при обновлении access_token для пользователя с tg_id: {tg_id} - {e}")
-
-
-def get_group_name_and_id(group_link, access_token):
-    match = re.search(r'vk\.com/(.+)', group_link)
-    
-    if match:
-        group_name = match.group(1)  
-    else:
-        print("Некорректная ссылка группы.")
-        return None, None
+    breaker = get_breaker('oauth')
+    if breaker.is_open and time.time() < breaker.retry_at:
+        return
 
-    url = "https://api.vk.com/method/groups.getById"
-    params = {
-        'group_id': group_name,  
-        'access_token': access_token,
-        'v': VERSION
-    }
-    encoded_params = urllib.parse.urlencode(params)
-    response = requests.get(url, params=encoded_params)
-    result = response.json()
-    
-    if 'error' in result:
-        print(f"Ошибка: {result['error']['error_msg']}")
-        return None, None
-    
-    group_info = result.get('response')
-    if group_info:
-        return group_name, group_info['groups'][0]['id'] 
-    return None, None   
-
-async def upload_and_publish_video(group_id: int, description: str, temp_file_path: str, tg_id: int):
-    access_token = get_token_by_tg_id(tg_id)
-    params = {
-        'title': description,
-        'access_token': access_token,
-        'group_id': group_id,
-        'description': description,
-        'v': VERSION
-    }
-    encoded_params = urllib.parse.urlencode(params)
-    access_token = get_token_by_tg_id(tg_id)
-    response = requests.post('https://api.vk.com/method/video.save', params=encoded_params)
-    raw = response.json()
-    
-    if 'response' not in raw:
-        raise Exception(raw)
+    users = await run_db(get_users_with_expiring_tokens, int(time.time()) + TOKEN_REFRESH_MARGIN)
+    if not users:
+        return
 
-    upload_url = raw['response']['upload_url']
-    video_id = raw['response']['video_id']
+    semaphore = asyncio.Semaphore(TOKEN_REFRESH_CONCURRENCY)
 
-    with open(temp_file_path, 'rb') as video_file:
-        video_file_bytes = video_file.read()
+    async def refresh(user):
+        async with semaphore:
+            await refresh_user_token(*user)
 
-    upload_response = requests.post(upload_url, files={'video_file': video_file_bytes})
+    await asyncio.gather(*(refresh(user) for user in users))
 
-    if upload_response.status_code != 200:
-        print(f"Ошибка при загрузке видео: {upload_response.text}")
-        return None
 
-    post_url = 'https://api.vk.com/method/wall.post'
-    post_params = {
-        'owner_id': -group_id,
-        'from_group': 1,
-        'attachments': f'video{-group_id}_{video_id}',
-        'access_token': access_token,
-        'v': VERSION
-    }
-    encoded_post_params = urllib.parse.urlencode(post_params)
-    access_token = get_token_by_tg_id(tg_id)
-    post_response = requests.post(post_url, params=encoded_post_params)
+GROUP_LINK_PATTERN = re.compile(r'(?:https?://)?(?:www\.|m\.)?vk\.(?:com|ru)/([A-Za-z0-9_.]+)(?![\w.-])')
+# Пути страниц, которые не являются группами: записи, видео, альбомы, страницы пользователей и т.п.
+NON_GROUP_PATH = re.compile(
+    r'(?:id|wall|video|clip|photo|album|topic|board|market|product|audio|doc|note|page|poll|story)-?\d+(?:_\d+)?',
+    re.IGNORECASE
+)
 
-    if post_response.status_code != 200:
-        print(f"Ошибка при публикации видео: {post_response.text}")
-        return None
 
-    try:
-        os.remove(temp_file_path)
-        print(f"Временный файл {temp_file_path} успешно удален.")
-    except Exception as e:
-        print(f"Ошибка при удалении временного файла {temp_file_path}: {e}")
-
-    return post_response.json()
+def parse_group_links(text: str) -> list[tuple[str, str]]:
+    """
+    Находит в тексте все ссылки на группы VK и возвращает пары (ссылка, короткое имя) без повторов.
+    Ссылка приводится к виду https://vk.com/<имя>, короткое имя - к нижнему регистру.
+    Ссылки на записи, видео и другие страницы, которые не являются группами, пропускаются.
+    """
+    links = {}
+    for match in GROUP_LINK_PATTERN.finditer(text):
+        path = match.group(1).rstrip('.')
+        if not path or NON_GROUP_PATH.fullmatch(path):
+            continue
+        links.setdefault(path.lower(), f'https://vk.com/{path}')
+    return [(link, screen_name) for screen_name, link in links.items()]
 
-async def schedule_video_publish(group_id: int, tg_id: int, publish_time: datetime, description: str, temp_file_path: str):
-    scheduler.add_job(lambda: asyncio.run(upload_and_publish_video(group_id, description, temp_file_path, tg_id)), 'date', run_date=publish_time)
 
-def check_vk_token(user_access_token):
-    url = "https://api.vk.com/method/secure.checkToken"
-    params = {
-        'access_token': CLIENT_SECRET,
-        'token': user_access_token,
-        'v': VERSION
-    }
+def _group_aliases(group: dict) -> list[str]:
+    group_id = group['id']
+    aliases = [f'club{group_id}', f'public{group_id}', f'event{group_id}', str(group_id)]
+    if group.get('screen_name'):
+        aliases.append(group['screen_name'].lower())
+    return aliases
 
-    encoded_params = urllib.parse.urlencode(params)
-    response = requests.get(url, params=encoded_params)
-    result = response.json()
-    
-    if 'error' in result:
-        return False  
 
-    if 'response' in result and result['response'].get('success') == 1:
-        return True  
+async def resolve_groups(screen_names: list[str], access_token: str) -> dict[str, tuple[int, str]]:
+    """
+    Возвращает id и названия групп VK по коротким именам: {screen_name: (group_id, group_name)}.
+    Известные имена берутся из базы, остальные разрешаются одним вызовом groups.getById
+    и сохраняются. Если VK отклоняет весь список из-за одного неверного имени,
+    имена разрешаются по отдельности (запросы объединяются в execute).
+    Имена, которые разрешить не удалось, в ответ не попадают.
+    """
+    cached = await run_db(get_cached_groups, screen_names)
+    missing = [name for name in screen_names if name not in cached]
+    if not missing:
+        return cached
 
-    return False  
+    resolved = {}
+    try:
+        response = await vk_client.call('groups.getById', access_token, group_ids=','.join(missing))
+        groups = response['groups']
+    except VKAPIError as e:
+        print(f"Ошибка groups.getById для {len(missing)} групп: {e.msg}")
+        if len(missing) == 1:
+            groups = []
+        else:
+            responses = await asyncio.gather(*(
+                vk_client.call_batched('groups.getById', access_token, group_id=name) for name in missing
+            ), return_exceptions=True)
+            groups = [group for response in responses if isinstance(response, dict) for group in response['groups']]
+
+    for group in groups:
+        for alias in _group_aliases(group):
+            if alias in missing:
+                resolved[alias] = (group['id'], group.get('name') or group.get('screen_name') or alias)
+
+    if resolved:
+        await run_db(cache_groups, resolved)
+    return {**cached, **resolved}
+
+
+async def upload_video(group_id: int, description: str, temp_file_path: str, tg_id: int,
+                       job_id: Optional[int] = None) -> int:
+    """
+    Загружает видео в группу без публикации и возвращает его video_id.
+    Для задачи job_id результат video.save сохраняется в базе, и повторная попытка после
+    неудачной загрузки файла использует то же видео, не оставляя в группе пустых видео.
+    """
+    target = await run_db(get_publish_job_upload_target, job_id) if job_id is not None else None
+    if target is not None:
+        upload_url, video_id = target
+    else:
+        access_token = await run_db(get_token_by_tg_id, tg_id)
+        with VK_VIDEO_SAVE_SECONDS.time():
+            raw = await call_with_retry(
+                'video.save', vk_client.call, 'video.save', access_token,
+                title=description,
+                group_id=group_id,
+                description=description
+            )
+        upload_url, video_id = raw['upload_url'], raw['video_id']
+        if job_id is not None:
+            await run_db(set_publish_job_upload_target, job_id, upload_url, video_id)
+
+    with VK_UPLOAD_SECONDS.time():
+        await call_with_retry('upload', upload_video_file, upload_url, temp_file_path)
+    print(f"Видео {temp_file_path} загружено в группу {group_id}, video_id: {video_id}")
+    return video_id
+
+async def publish_video_post(group_id: int, video_id: int, tg_id: int, guid: Optional[str] = None,
+                             owner_id: Optional[int] = None, message: Optional[str] = None):
+    """
+    Публикует на стене группы пост с уже загруженным видео.
+    owner_id - владелец видео, если оно загружено в другую группу (по умолчанию сама группа),
+    message - текст поста.
+    VK не создает второй пост с тем же guid, поэтому повтор с одним guid безопасен.
+    """
+    access_token = await run_db(get_token_by_tg_id, tg_id)
+    attachment = f'video{owner_id or -group_id}_{video_id}'
+    with VK_WALL_POST_SECONDS.time():
+        post_response = await call_with_retry(
+            'wall.post', vk_client.call_batched, 'wall.post', access_token,
+            owner_id=-group_id,
+            from_group=1,
+            attachments=attachment,
+            message=message,
+            guid=guid or (attachment if owner_id in (None, -group_id) else f'{attachment}_{group_id}')
+        )
+    print(f"Видео {video_id} опубликовано в группе {group_id}")
+    return post_response
@@ -0,0 +1,242 @@
+import json
+import time
+import asyncio
+import aiohttp
+
+from typing import Final, Optional
+
+from env import (
+    VK_CONNECTION_LIMIT,
+    VK_CONNECTION_LIMIT_PER_HOST,
+    VK_KEEPALIVE_TIMEOUT,
+    VK_DNS_CACHE_TTL,
+    VK_CONNECT_TIMEOUT,
+    VK_REQUEST_TIMEOUT,
+    VK_RATE_LIMIT,
+    VK_EXECUTE_BATCH_SIZE,
+    VK_BATCH_WINDOW,
+    VK_API_URL,
+    VK_ID_URL,
+)
+
+VERSION: Final = '5.199'
+
+
+class VKAPIError(Exception):
+    def __init__(self, error: dict):
+        self.error = error
+        self.code = error.get('error_code')
+        self.msg = error.get('error_msg')
+        super().__init__(f"VK API error {self.code}: {self.msg}")
+
+
+class VKIDError(Exception):
+    def __init__(self, status: int, data: dict):
+        self.status = status
+        self.data = data
+        super().__init__(f"VK ID error {status}: {data}")
+
+
+class VKHTTPError(Exception):
+    """
+    VK ответил ошибкой сервера, 429 или телом, которое не является JSON (например, HTML-страницей 502).
+    """
+
+    def __init__(self, status: int, body: str):
+        self.status = status
+        self.body = body
+        super().__init__(f"VK HTTP {status}: {body[:200]}")
+
+
+async def read_json(response: aiohttp.ClientResponse) -> dict:
+    """
+    Разбирает JSON-ответ VK. При статусе 5xx или 429 и при не-JSON теле выбрасывает VKHTTPError.
+    """
+    text = await response.text(errors='replace')
+    if response.status >= 500 or response.status == 429:
+        raise VKHTTPError(response.status, text)
+    try:
+        return json.loads(text)
+    except ValueError:
+        raise VKHTTPError(response.status, text) from None
+
+
+def create_session(limit: int = VK_CONNECTION_LIMIT,
+                   limit_per_host: int = VK_CONNECTION_LIMIT_PER_HOST,
+                   total_timeout: Optional[float] = VK_REQUEST_TIMEOUT) -> aiohttp.ClientSession:
+    """
+    Создает aiohttp-сессию с пулом keep-alive соединений и кэшем DNS.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        keepalive_timeout=VK_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=VK_DNS_CACHE_TTL,
+        use_dns_cache=True,
+    )
+    timeout = aiohttp.ClientTimeout(total=total_timeout, sock_connect=VK_CONNECT_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты запросов: не больше rate запросов в секунду с запасом capacity.
+    Ожидающие получают разрешение в порядке очереди.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class VKClient:
+    """
+    Асинхронный клиент VK API поверх одной долгоживущей aiohttp-сессии.
+    Сессия создается лениво при первом запросе и закрывается через close().
+    Запросы с каждым токеном проходят через свой TokenBucket, а вызовы через
+    call_batched собираются в пакеты метода execute.
+    """
+
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = asyncio.Lock()
+        self._buckets: dict[str, TokenBucket] = {}
+        self._batches: dict[str, list] = {}
+        self._flush_handles: dict[str, asyncio.TimerHandle] = {}
+        self._batch_tasks: set[asyncio.Task] = set()
+
+    async def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            async with self._lock:
+                if self._session is None or self._session.closed:
+                    self._session = create_session()
+        return self._session
+
+    def _bucket(self, access_token: str) -> TokenBucket:
+        bucket = self._buckets.get(access_token)
+        if bucket is None:
+            bucket = self._buckets[access_token] = TokenBucket(VK_RATE_LIMIT)
+        return bucket
+
+    async def _request(self, method: str, access_token: str, params: dict, http_method: str = 'POST') -> dict:
+        params = {key: value for key, value in params.items() if value is not None}
+        params['access_token'] = access_token
+        params['v'] = VERSION
+
+        session = await self.session()
+        url = f'{VK_API_URL}/{method}'
+        await self._bucket(access_token).acquire()
+        if http_method == 'GET':
+            request = session.get(url, params=params)
+        else:
+            request = session.post(url, data=params)
+
+        # Ошибка 6 (Too many requests) не повторяется здесь: ее повторяет call_with_retry
+        async with request as response:
+            return await read_json(response)
+
+    async def call(self, method: str, access_token: str, http_method: str = 'POST', **params) -> dict:
+        """
+        Вызывает метод VK API и возвращает поле response.
+        При ошибке VK выбрасывает VKAPIError.
+        """
+        result = await self._request(method, access_token, params, http_method)
+        if 'error' in result:
+            raise VKAPIError(result['error'])
+        return result['response']
+
+    async def call_batched(self, method: str, access_token: str, **params) -> dict:
+        """
+        То же, что call, но вызовы с одним токеном, пришедшие в течение VK_BATCH_WINDOW,
+        отправляются одним запросом execute (до VK_EXECUTE_BATCH_SIZE вызовов).
+        """
+        params = {key: value for key, value in params.items() if value is not None}
+        future = asyncio.get_running_loop().create_future()
+        batch = self._batches.setdefault(access_token, [])
+        batch.append((method, params, future))
+
+        if len(batch) >= VK_EXECUTE_BATCH_SIZE:
+            self._flush(access_token)
+        elif len(batch) == 1:
+            self._flush_handles[access_token] = asyncio.get_running_loop().call_later(
+                VK_BATCH_WINDOW, self._flush, access_token
+            )
+        return await future
+
+    def _flush(self, access_token: str) -> None:
+        handle = self._flush_handles.pop(access_token, None)
+        if handle is not None:
+            handle.cancel()
+        batch = self._batches.pop(access_token, None)
+        if batch:
+            task = asyncio.create_task(self._execute_batch(access_token, batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _execute_batch(self, access_token: str, batch: list) -> None:
+        if len(batch) == 1:
+            method, params, future = batch[0]
+            try:
+                result = await self.call(method, access_token, **params)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            return
+
+        calls = ','.join(
+            f'API.{method}({json.dumps(params, ensure_ascii=False)})' for method, params, _ in batch
+        )
+        try:
+            raw = await self._request('execute', access_token, {'code': f'return [{calls}];'})
+            if 'error' in raw:
+                raise VKAPIError(raw['error'])
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        errors = iter(raw.get('execute_errors', []))
+        for (method, _, future), value in zip(batch, raw['response']):
+            if future.done():
+                continue
+            if value is False:
+                future.set_exception(VKAPIError(next(errors, {'error_msg': f'{method} не выполнен'})))
+            else:
+                future.set_result(value)
+        for method, _, future in batch:
+            if not future.done():
+                future.set_exception(VKAPIError({'error_msg': f'execute не вернул результат {method}'}))
+
+    async def post_form(self, url: str, data: dict) -> tuple[int, dict]:
+        """
+        Отправляет form-urlencoded POST (используется для VK ID) и возвращает статус и тело ответа.
+        """
+        session = await self.session()
+        async with session.post(url, data=data) as response:
+            return response.status, await read_json(response)
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+vk_client = VKClient()
@@ -0,0 +1,114 @@
+import os
+import re
+import uuid
+import asyncio
+import aiohttp
+
+from typing import Optional
+
+from env import VK_UPLOAD_TIMEOUT, VK_UPLOAD_CHUNK_SIZE, VK_UPLOAD_CHUNK_RETRIES
+from vk_client import vk_client, read_json
+from metrics import RETRIES_TOTAL
+
+
+class UploadError(Exception):
+    pass
+
+
+class ChunkedUploadNotSupported(UploadError):
+    pass
+
+
+def _read_chunk(path: str, offset: int, size: int) -> bytes:
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        return file.read(size)
+
+
+def _parse_received_offset(body: str, total: int) -> Optional[int]:
+    """
+    Разбирает ответ сервера загрузки вида '0-1048575/5242880' и возвращает
+    смещение, с которого нужно продолжить загрузку.
+    """
+    match = re.match(r'\s*0-(\d+)/(\d+)', body)
+    if match and int(match.group(2)) == total:
+        return int(match.group(1)) + 1
+    return None
+
+
+async def _upload_multipart(upload_url: str, path: str) -> dict:
+    """
+    Загрузка одним multipart-запросом. Файл читается с диска потоково,
+    целиком в память не попадает.
+    """
+    session = await vk_client.session()
+    with open(path, 'rb') as video_file:
+        form = aiohttp.FormData()
+        form.add_field('video_file', video_file, filename=os.path.basename(path))
+        async with session.post(upload_url, data=form, timeout=aiohttp.ClientTimeout(total=VK_UPLOAD_TIMEOUT)) as response:
+            if response.status != 200:
+                raise UploadError(f"{response.status} - {await response.text()}")
+            return await read_json(response)
+
+
+async def _upload_chunked(upload_url: str, path: str, chunk_size: int) -> dict:
+    """
+    Загрузка частями с заголовком Content-Range. При ошибке часть
+    отправляется повторно, начиная с последнего подтвержденного смещения.
+    """
+    session = await vk_client.session()
+    total = os.path.getsize(path)
+    session_id = uuid.uuid4().hex
+    filename = os.path.basename(path)
+    offset = 0
+    failures = 0
+
+    while offset < total:
+        chunk = await asyncio.to_thread(_read_chunk, path, offset, chunk_size)
+        end = offset + len(chunk) - 1
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Content-Range': f'bytes {offset}-{end}/{total}',
+            'Session-ID': session_id,
+        }
+        try:
+            async with session.post(upload_url, data=chunk, headers=headers,
+                                    timeout=aiohttp.ClientTimeout(total=VK_UPLOAD_TIMEOUT)) as response:
+                body = await response.text()
+                if response.status == 200 and end + 1 == total:
+                    return await read_json(response)
+                if response.status in (200, 201):
+                    offset = _parse_received_offset(body, total) or end + 1
+                    failures = 0
+                    continue
+                if offset == 0 and 400 <= response.status < 500:
+                    raise ChunkedUploadNotSupported(f"{response.status} - {body}")
+                raise UploadError(f"{response.status} - {body}")
+        except (aiohttp.ClientError, asyncio.TimeoutError, UploadError) as e:
+            if isinstance(e, ChunkedUploadNotSupported):
+                raise
+            failures += 1
+            if failures > VK_UPLOAD_CHUNK_RETRIES:
+                raise UploadError(f"Не удалось загрузить часть {offset}-{end}: {e}")
+            RETRIES_TOTAL.inc(operation='vk_upload_chunk')
+            print(f"Ошибка при загрузке части {offset}-{end} файла {path}: {e}. Повтор {failures}/{VK_UPLOAD_CHUNK_RETRIES}")
+            await asyncio.sleep(failures)
+
+    raise UploadError("Сервер не подтвердил завершение загрузки")
+
+
+async def upload_video_file(upload_url: str, path: str, chunk_size: int = VK_UPLOAD_CHUNK_SIZE) -> dict:
+    """
+    Загружает файл на upload_url, полученный из video.save.
+    Файлы больше chunk_size отправляются частями, остальные одним потоковым запросом.
+    Пиковое потребление памяти не превышает chunk_size.
+    """
+    if os.path.getsize(path) <= chunk_size:
+        return await _upload_multipart(upload_url, path)
+
+    try:
+        return await _upload_chunked(upload_url, path, chunk_size)
+    except ChunkedUploadNotSupported as e:
+        print(f"Сервер загрузки не принимает загрузку частями ({e}), отправляем файл целиком")
+        return await _upload_multipart(upload_url, path)
@@ -0,0 +1,70 @@
+import signal
+import asyncio
+import multiprocessing
+
+from env import WORKER_PROCESSES, WORKER_ID, METRICS_HOST, METRICS_PORT
+from publish_queue import publish_dispatcher
+from vk_client import vk_client
+from metrics import start_metrics_server
+
+
+async def worker_main(worker_id: str, metrics_port: int = 0) -> None:
+    """
+    Процесс-воркер: разбирает общую очередь publish_jobs (загрузка видео и wall.post)
+    до получения SIGTERM или SIGINT. Метрики воркера отдаются на metrics_port.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    metrics_runner = await start_metrics_server(METRICS_HOST, metrics_port)
+    publish_dispatcher.owner = worker_id
+    await publish_dispatcher.start()
+    print(f"Воркер {worker_id} запущен")
+    try:
+        await stop.wait()
+    finally:
+        await publish_dispatcher.stop()
+        await vk_client.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        print(f"Воркер {worker_id} остановлен")
+
+
+def run_worker(worker_id: str, metrics_port: int = 0) -> None:
+    asyncio.run(worker_main(worker_id, metrics_port))
+
+
+def start_workers(count: int = WORKER_PROCESSES) -> list[multiprocessing.Process]:
+    """
+    Запускает count процессов-воркеров (по умолчанию ни одного). Ограничения такого режима
+    описаны в README: лимит запросов к VK и кэши у каждого процесса свои.
+    Id воркеров строятся из WORKER_ID и номера, поэтому различаются между собой и с ботом
+    (WORKER_ID:bot) и не меняются после перезапуска: воркер сразу возвращает в очередь свои
+    прерванные задачи.
+    Метрики воркера с номером N отдаются на порту METRICS_PORT + N.
+    """
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for index in range(1, count + 1):
+        worker_id = f'{WORKER_ID}:worker-{index}'
+        process = context.Process(target=run_worker, args=(worker_id, METRICS_PORT + index if METRICS_PORT else 0), name=worker_id)
+        process.start()
+        processes.append(process)
+    return processes
+
+
+def stop_workers(processes: list[multiprocessing.Process], timeout: float = 30) -> None:
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(timeout)
+        if process.is_alive():
+            print(f"Воркер {process.name} не завершился за {timeout} c, процесс будет убит")
+            process.kill()
+            process.join()
+
+
+if __name__ == '__main__':
+    run_worker(f'{WORKER_ID}:worker', METRICS_PORT)